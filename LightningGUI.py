@@ -9,18 +9,31 @@ __status__ = "Prototype"
 __date__ = "6-16-2022"
 
 import sys
+import multiprocessing
 #import time
 import os
+import traceback
 # tkinter required for pyinstaller
 import tkinter
 from PIL import Image, ImageTk
-import cv2
-import imageio
+
+from zapcapture import (
+    AnalysisError,
+    DEFAULT_THRESHOLD,
+    Options,
+    REPORT_NAME,
+    analyze_folder,
+    load_report,
+    summary,
+)
+from zapcapture.index import FAST_RATE, FAST_SIZE
+from zapcapture.threshold import AUTO_FRACTION, AUTO_K
 
 # imports for gui interface
 from PySide2.QtCore import Qt, QObject, QThread, Signal, Slot
 from PySide2.QtWidgets import (
     QApplication,
+    QCheckBox,
     QLabel,
     QMainWindow,
     QPushButton,
@@ -39,12 +52,6 @@ from PySide2.QtGui import (
     QIcon
 )
 
-#global constants
-SCALE = 0.5
-NOISE_CUTOFF = 5
-BLUR_SIZE = 3
-END_STRIKE_PERCENTAGE = .9
-GIF_FRAMES_LIMIT = 100
 # input, output, and threshold are manipulated by the directory select buttons
 # this allows them to pass into the worker thread without slots and signals.
 # as such they are used as global variables
@@ -54,27 +61,38 @@ input_folder = 'No Folder Chosen'
 global output_folder
 output_folder = 'No Folder Chosen'
 global threshold
-threshold = '5000000'
+threshold = str(DEFAULT_THRESHOLD)
+# follow each video's own noise level instead of using the threshold as is
+global auto_threshold
+auto_threshold = False
+# scan small and strided until something happens, then in full
+global fast_scan
+fast_scan = False
 # buttonstate determines output file name type.
 global buttonState
 buttonState = True
-
-
-def count_diff(img1, img2):
-    # Finds a difference between a frame and the frame before it.
-    small1 = cv2.resize(img1, (0, 0), fx=SCALE, fy=SCALE)
-    small2 = cv2.resize(img2, (0, 0), fx=SCALE, fy=SCALE)
-    diff = cv2.absdiff(small1, small2)
-    diff = cv2.cvtColor(diff, cv2.COLOR_RGB2GRAY)
-    frame_delta1 = cv2.threshold(diff, NOISE_CUTOFF, 255, 3)[1]
-    frame_delta1_color = cv2.cvtColor(frame_delta1, cv2.COLOR_GRAY2RGB)
-    delta_count1 = cv2.countNonZero(frame_delta1)
-
-    return delta_count1
+# number of videos analyzed at once, each in its own process.
+global processes
+processes = '1'
+# skip videos already analyzed into the output folder with the same settings
+global resume
+resume = True
+# optional mask image of the area to analyze, None analyzes everything
+global mask_file
+mask_file = None
+# compare frames with a running average background instead of the last frame
+global background_average
+background_average = False
+# also write the per frame diffs as <video>.csv, as older versions did
+global write_csv
+write_csv = False
+# cut strike clips straight out of the video instead of encoding them
+global copy_clips
+copy_clips = False
 
 
 def error_popup(message):
-    '''Might cause a crash, but since it is for errors I am less inclined to worry.'''
+    '''Error popup. Only call from the main thread, see Worker.error.'''
     print(message)
     msg = QMessageBox()
     msg.setIcon(QMessageBox.Warning)
@@ -86,18 +104,17 @@ def error_popup(message):
     msg.exec_()
 
 # Popup for info after analysis. Caused crashes when started from
-# the analysis thread rather than the main thread.
-# Might reintroduce one day, since it provides nice information.
-
-# def info_popup(message):
-#     msg = QMessageBox()
-#     msg.setIcon(QMessageBox.Information)
-#     msg.setText("Analysis Complete!")
-#     msg.setInformativeText(str(message))
-#     msg.setWindowTitle("Lightning Analysis Complete")
-#     # prevents crash after closing message box
-#     msg.setAttribute(Qt.WA_DeleteOnClose)
-#     msg.exec_()
+# the analysis thread, so the worker sends the text to the main thread
+# with its report signal instead.
+def info_popup(message):
+    msg = QMessageBox()
+    msg.setIcon(QMessageBox.Information)
+    msg.setText("Analysis Complete!")
+    msg.setInformativeText(str(message))
+    msg.setWindowTitle("Lightning Analysis Complete")
+    # prevents crash after closing message box
+    msg.setAttribute(Qt.WA_DeleteOnClose)
+    msg.exec_()
 
 class HyperlinkLable(QLabel):
     def __init__(self, parent=None):
@@ -110,205 +127,64 @@ class Worker(QObject):
     # worker thread for the analysis.
     finished = Signal()
     threadProgress = Signal(int)
+    # popups must be shown from the main thread, so the text goes there
+    report = Signal(str)
+    error = Signal(str)
 
     def run(self):
         """Analyzes lightning. """
         # Launches analysis of the videos in the in directory.
+        # The detection itself lives in zapcapture.core so it can also run
+        # headless; this only feeds it the gui state.
         print('Started Analysis!')
         global input_folder
         global output_folder
         global threshold
         global buttonState
-        in_folder = input_folder
-        out_folder = output_folder
-        threshold_integer = int(threshold)
-        # set framecount, strike counter to zero before looping all frames
-        frame_count = 0
-        strikes = 0
-        # set progress bar to 10 so people know it is working
-        self.threadProgress.emit(10)
+        global processes
+        global resume
+        global mask_file
+        global background_average
+        global auto_threshold
+        global fast_scan
+        global write_csv
+        global copy_clips
+        options = Options(resume=resume, mask=mask_file,
+                          background='average' if background_average else 'previous',
+                          csv=write_csv,
+                          clip_mode='copy' if copy_clips else 'encode')
+        if auto_threshold:
+            # the entered threshold isn't used, a small share of the frame
+            # is the floor instead
+            options.threshold_k = AUTO_K
+            options.threshold_fraction = AUTO_FRACTION
+        if fast_scan:
+            options.two_pass = True
+            options.scan_pixels = FAST_SIZE[0]*FAST_SIZE[1]
+            options.scan_rate = FAST_RATE
         try:
-            # error if the folder is invalid. Check folder for verification.
-            path, dirs, files = next(os.walk(in_folder))
-            filecount = len(files)
-        except:
-            error_popup('Input folder not valid. Select a valid folder.')
+            analyze_folder(input_folder, output_folder, int(threshold or 0),
+                           name_by_frame=buttonState,
+                           progress=lambda value: self.threadProgress.emit(int(value)),
+                           workers=int(processes or 1),
+                           options=options)
+            # statistics for nerds! The full stage times are in the run
+            # report in the output folder.
+            report = load_report(os.path.join(output_folder, REPORT_NAME))
+            self.report.emit(summary(report) + '\n\nFull report: ' + REPORT_NAME)
+        except AnalysisError as e:
+            self.error.emit(str(e))
             self.threadProgress.emit(0)
-            self.finished.emit()
-            return
-        try:
-            # determine if the output folder is valid
-            path, dirs, files = next(os.walk(out_folder))
-            outfilecount = len(files)
-        except:
-            error_popup('Output folder not valid. Select a valid folder.')
+        except Exception as e:
+            # anything else is a bug or a broken video; the traceback goes
+            # to the console and the button comes back either way
+            traceback.print_exc()
+            self.error.emit('The analysis stopped with an error:\n%s: %s'
+                            % (type(e).__name__, e))
             self.threadProgress.emit(0)
+        finally:
+            # sends finished signal. Essentially terminates the thread.
             self.finished.emit()
-            return
-        # create frame and gif directories after checking for existence
-        impath = os.path.join(out_folder, 'frames/')
-        gifpath = os.path.join(out_folder, 'gifs/')
-        if not os.path.isdir(impath):
-            os.mkdir(impath)
-        if not os.path.isdir(gifpath):
-            os.mkdir(gifpath)
-        # get the current directory files count. If the outfolder is the same
-        # as the infolder, this might have changed after creating the output
-        # folders above.
-        path, dirs, files = next(os.walk(in_folder))
-        filecount = len(files)+len(dirs)
-        # set per file progress bar quantity
-        per_file = 90/(filecount)
-        for index, filename in enumerate(os.listdir(in_folder)):
-            # itterates over files in directory
-            # f_in and f_out control input and destination targets
-            print('Processing ' + filename)
-            try:
-                file_base = 10 + index*per_file
-                completion = file_base
-            except:
-                self.threadProgress.emit(0)
-                self.finished.emit()
-                return
-            self.threadProgress.emit(completion)
-            f_in = os.path.join(in_folder, filename)
-            f_out = os.path.join(out_folder, filename)
-            try:
-                video = cv2.VideoCapture(f_in)
-            except:
-                print('video lib error?')
-                return
-            # gets statistics on current video
-            nframes = (int)(video.get(cv2.CAP_PROP_FRAME_COUNT))
-            width = (int)(video.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = (int)(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            fps = (int)(video.get(cv2.CAP_PROP_FPS))
-            #print('FPS is '+ str(fps))
-            # video diagnostics printout for user ease.
-            # Might incorporate into visible log at later date
-            frame_size = "Frame size: " + str(width) + str(height) + '\n'
-            total_frames = "Total frames: " + str(nframes) + '\n'
-            video_fps = "Fps: " + str(fps) + '\n'
-            # print(frame_size)
-            # print(total_frames)
-            # print(video_fps)
-            # checks if input is an actual video before opening csv.
-            # opens csv for statistics- might want to disable for production.
-            if fps == 0 or nframes == 1:
-                print('zerofps or image!')
-                continue
-            fff = open(f_out+".csv", 'w')
-            # reads the video out to give a frame and flag
-            flag, frame0 = video.read()
-            # Set video codec.
-            print("setting codec mp4v")
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            print("codec successful!")
-            # savestate for using the deadzone.
-            deadzone = 0
-            # creates list for gif frames
-            gif_frames = []
-            gif_name = ''
-            # strike counter independent for file. Helps with writing gifs.
-            file_strikes = 0
-            # remove filename period, so that the output files don't confuse anything.
-            filename = filename.replace('.', '_')
-            for i in range(nframes-1):
-                # loops through all of the frames, looking for strikes.
-                # itterate progress bar
-                file_cap = (i/(nframes+1))*per_file
-                file_completion = file_base + file_cap
-                self.threadProgress.emit(file_completion)
-                # process the video
-                flag, frame1 = video.read()
-                diff1 = count_diff(frame0, frame1)
-                # checks for file output name system
-                # names files and gifs respectively.
-                if not buttonState and type(fps) == int:
-                    timestamp = str(round(int(i)/int(fps), 2)).replace('.', '-')
-                    imname = impath + '/' + str(filename) + str(timestamp) + '.png'
-                    gifname = gifpath + '/' + str(filename) + str(timestamp) + '.mp4'
-                else:
-                    imname = impath + str(filename) + "_%06d.png" % i
-                    gifname = gifpath + str(filename) + "_%06d.mp4" % i
-                if len(gif_frames) == GIF_FRAMES_LIMIT:
-                    # end a gif if the clip gets large to prevent computer issues.
-                    # massive gifs can cause lag and other problems.
-                    deadzone = 0
-                if diff1 > threshold_integer:
-                    # pass condition to save a frame and start a save state
-                    strikes = strikes + 1
-                    file_strikes = file_strikes + 1
-                    gif_name = gifname
-                    # write previous gif list to a gif if not the second frame
-                    # and the deadzone is already zero (ie lightning has already
-                    # struck and the gif buffer contains frames).
-                    if deadzone == 0 and file_strikes > 1:
-                        gif_start_frame = gif_frames[0]
-                        gif_frames.pop(0)
-                        print('setting writer')
-                        out = cv2.VideoWriter(gif_name, fourcc, 4.0, (width,height))
-                        for idx, frame in enumerate(gif_frames):
-                            print('writing frame')
-                            out.write(frame)
-                            print('wrote frame')
-                        out.release()
-                        gif_frames = []
-                    # deadzone must be an int > 0 to save an image.
-                    deadzone = 3
-                    gif_name = gifname
-
-                if diff1 < threshold_integer*END_STRIKE_PERCENTAGE:
-                    # itterates deadzone to zero, leaving deadzone condition.
-                    # if the diff is less than the end strike percentage, the
-                    # deadzone is reduced by 1. Deadzone of 0 will result
-                    # in not saving the frame.
-                    #end strike percentage set in the initial constants.
-                    #still need to find the sweet spot between 1% and 30%.
-                    if deadzone > 0:
-                        deadzone = deadzone - 1
-
-                if deadzone > 0:
-                    # save frame for passing the deadzone condition.
-                    cv2.imwrite(imname, frame1)
-                    # save frame to list for writing to gif
-                    gif_frames.append(frame1)
-
-                text = str(f_out)+', '+str(diff1)
-                # write threshold data to csv
-                fff.write(text + '\n')
-                fff.flush()
-                # pass frame forward
-                frame0 = frame1
-                if i == nframes-1 and not gif_frames[0]:
-                    # saves a gif at the end of a file
-                    gif_start_frame = gif_frames[0]
-                    gif_frames.pop(0)
-                    print('setting writer')
-                    out = cv2.VideoWriter(gif_name, fourcc, 4.0, (width,height))
-                    for idx, frame in enumerate(gif_frames):
-                        print('writing frame')
-                        out.write(frame)
-                        print('wrote frame')
-                    out.release()
-                    gif_frames = []
-                    deadzone = 0
-        self.threadProgress.emit(100)
-        fff.close()
-        print('analysis complete!')
-        # statistics for nerds!
-        # video_strikes = 'Strikes: ' + str(strikes) + '\n'
-        # elapsed_time = 'Process Time: ' + str(int(time.time() - start)) + ' s\n'
-        # print(video_strikes)
-        # print(elapsed_time)
-        # info = video_strikes+elapsed_time
-        # looks like calling popups from this thread can cause crashes.
-        # For stability, I am removing the info popup. Error popups will be left
-        # for now, but need to be fixed.
-
-        # info_popup(info)
-        # sends finished signal. Essentially terminates the thread.
-        self.finished.emit()
 
 
 class Window(QMainWindow):
@@ -352,6 +228,40 @@ class Window(QMainWindow):
         # restricts the threshold to be numbers only
         self.onlyInt = QIntValidator()
         self.thresholdEntry.setValidator(self.onlyInt)
+        self.autoThresholdButton = QCheckBox("Automatic Threshold (❓)")
+        self.autoThresholdButton.setChecked(auto_threshold)
+        self.autoThresholdButton.setToolTip('Work out the threshold from each video as it goes: a frame counts as lightning when it changes much more than the frames just before it. One setting then works for a folder of mixed cameras, resolutions and lighting. The threshold above is not used while this is checked.')
+        self.autoThresholdButton.toggled.connect(
+            lambda checked: self.thresholdEntry.setEnabled(not checked))
+        self.thresholdEntry.setEnabled(not auto_threshold)
+        # process count widget
+        self.processesLabel = QLabel("Parallel Videos (❓)", self)
+        self.processesLabel.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+        self.processesLabel.setToolTip('Number of processor cores used for analysis. 0 uses every core. Videos are analyzed at the same time, or long videos are split into pieces when the folder has fewer videos than cores. More cores finish faster, but use more memory.')
+        self.processesEntry = QLineEdit(processes)
+        self.processesEntry.setValidator(QIntValidator(0, 256))
+        # mask widgets
+        self.maskButton = QPushButton("Select Mask Image (Optional)", self)
+        self.maskButton.clicked.connect(self.pick_new_mask)
+        self.maskButton.setToolTip('A mask image leaves parts of the frame out of the analysis, such as roads with headlights, swaying trees or a timestamp. Paint the area to analyze white and the rest black, eg. over a screenshot of the video. A video with its own image named like it with .mask.png uses that instead. Cancel the dialog to analyze the whole frame.')
+        self.maskLabel = QLabel('Whole Frame')
+        self.maskLabel.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+        self.backgroundButton = QCheckBox("Average Background (❓)")
+        self.backgroundButton.setChecked(background_average)
+        self.backgroundButton.setToolTip('Compare each frame with an average of the frames before it instead of only the previous frame. Slow changes like clouds, dusk and camera noise fade into the background, so a lower threshold can find faint strikes and sprites.')
+        self.fastButton = QCheckBox("Fast Scan (❓)")
+        self.fastButton.setChecked(fast_scan)
+        self.fastButton.setToolTip('Look through each video at a small size, and for high frame rate footage only at every few frames, until something starts to change, then at every frame in full. Up to about twice as fast through quiet 4K or 60fps footage, but every frame is still decoded and a video full of lightning can take as long as without it. The strike images and clips are the same. A flash shorter than 1/%d of a second can be missed.' % FAST_RATE)
+        self.copyClipsButton = QCheckBox("Copy Clips From Video (❓)")
+        self.copyClipsButton.setChecked(copy_clips)
+        self.copyClipsButton.setToolTip('Cut each strike clip straight out of the video instead of encoding a new one, so clips keep the original quality and frame rate and cost almost no time to write. Needs ffmpeg installed. A clip can only start at a keyframe of the video, so it may start up to a few seconds before the strike.')
+        self.csvButton = QCheckBox("Write CSV (❓)")
+        self.csvButton.setChecked(write_csv)
+        self.csvButton.setToolTip('Also write the difference of every frame to a csv file per video, as older versions did. The strikes are always saved to a small .strikes.json table per video, with the frame numbers, times and files of each one, and the differences to a .npy file.')
+        # resume widget
+        self.resumeButton = QCheckBox("Skip Finished Videos (❓)")
+        self.resumeButton.setChecked(resume)
+        self.resumeButton.setToolTip('Videos already analyzed into the output folder with the same settings are skipped, and a video that was stopped partway carries on from where it got to. Adding new videos to a folder then only analyzes the new ones. Uncheck to analyze everything again.')
         self.analysisButton = QPushButton('Perform Analysis', self)
         # self.analysisButton.clicked.connect(self.analysis)
         self.analysisButton.clicked.connect(self.runLongTask)
@@ -376,6 +286,16 @@ class Window(QMainWindow):
         layout.addWidget(self.outputTimestampButton)
         layout.addWidget(self.thresholdLabel)
         layout.addWidget(self.thresholdEntry)
+        layout.addWidget(self.autoThresholdButton)
+        layout.addWidget(self.processesLabel)
+        layout.addWidget(self.processesEntry)
+        layout.addWidget(self.maskButton)
+        layout.addWidget(self.maskLabel)
+        layout.addWidget(self.backgroundButton)
+        layout.addWidget(self.fastButton)
+        layout.addWidget(self.copyClipsButton)
+        layout.addWidget(self.csvButton)
+        layout.addWidget(self.resumeButton)
         layout.addWidget(self.analysisButton)
         layout.addWidget(self.progressBar)
         layout.addWidget(self.starvationButton)
@@ -401,6 +321,15 @@ class Window(QMainWindow):
         self.progressBar.setValue(0)
         self.analysisButton.setEnabled(True)
 
+    def pick_new_mask(self):
+        dialog = QFileDialog()
+        file_path = dialog.getOpenFileName(None, "Select Mask Image", "",
+                                           "Images (*.png *.jpg *.bmp)")[0]
+        global mask_file
+        # cancelling goes back to the whole frame
+        mask_file = str(file_path) or None
+        self.maskLabel.setText(mask_file or 'Whole Frame')
+
     def btnstate(self, b):
         global buttonState
         if b.text() == "Frame Number":
@@ -415,6 +344,20 @@ class Window(QMainWindow):
         # set the threshold
         global threshold
         threshold = self.thresholdEntry.text()
+        global auto_threshold
+        auto_threshold = self.autoThresholdButton.isChecked()
+        global fast_scan
+        fast_scan = self.fastButton.isChecked()
+        global processes
+        processes = self.processesEntry.text()
+        global resume
+        resume = self.resumeButton.isChecked()
+        global background_average
+        background_average = self.backgroundButton.isChecked()
+        global write_csv
+        write_csv = self.csvButton.isChecked()
+        global copy_clips
+        copy_clips = self.copyClipsButton.isChecked()
         # Step 2: Create a QThread object
         self.thread = QThread()
         # Step 3: Create a worker object
@@ -423,6 +366,11 @@ class Window(QMainWindow):
         self.worker.moveToThread(self.thread)
         # setup progress bar signal
         self.worker.threadProgress.connect(self.onCountChanged)
+        # popups run in the main thread, queued from the worker. The slots
+        # have to be window methods; plain functions would run in the
+        # worker thread.
+        self.worker.report.connect(self.showReport)
+        self.worker.error.connect(self.showError)
         # Step 5: Connect signals and slots
         self.thread.started.connect(self.worker.run)
         self.worker.finished.connect(self.thread.quit)
@@ -445,31 +393,42 @@ class Window(QMainWindow):
     def enableAnalysisButton(self):
         self.analysisButton.setEnabled(True)
 
-
-app = QApplication(sys.argv)
-
-# Dark Mode code
-# Force the style to be the same on all OSs:
-app.setStyle("Fusion")
-
-# Now use a palette to switch to dark colors:
-palette = QPalette()
-palette.setColor(QPalette.Window, QColor(53, 53, 53))
-palette.setColor(QPalette.WindowText, Qt.white)
-palette.setColor(QPalette.Base, QColor(25, 25, 25))
-palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
-palette.setColor(QPalette.ToolTipBase, Qt.black)
-palette.setColor(QPalette.ToolTipText, Qt.white)
-palette.setColor(QPalette.Text, Qt.white)
-palette.setColor(QPalette.Button, QColor(53, 53, 53))
-palette.setColor(QPalette.ButtonText, Qt.white)
-palette.setColor(QPalette.BrightText, Qt.red)
-palette.setColor(QPalette.Link, QColor(42, 130, 218))
-palette.setColor(QPalette.Highlight, QColor(42, 130, 218))
-palette.setColor(QPalette.HighlightedText, Qt.black)
-app.setPalette(palette)
-
-# finish building window
-win = Window()
-win.show()
-sys.exit(app.exec_())
+    @Slot(str)
+    def showReport(self, message):
+        info_popup(message)
+
+    @Slot(str)
+    def showError(self, message):
+        error_popup(message)
+
+
+if __name__ == '__main__':
+    # required for the process pool in frozen (pyinstaller) builds
+    multiprocessing.freeze_support()
+    app = QApplication(sys.argv)
+
+    # Dark Mode code
+    # Force the style to be the same on all OSs:
+    app.setStyle("Fusion")
+
+    # Now use a palette to switch to dark colors:
+    palette = QPalette()
+    palette.setColor(QPalette.Window, QColor(53, 53, 53))
+    palette.setColor(QPalette.WindowText, Qt.white)
+    palette.setColor(QPalette.Base, QColor(25, 25, 25))
+    palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
+    palette.setColor(QPalette.ToolTipBase, Qt.black)
+    palette.setColor(QPalette.ToolTipText, Qt.white)
+    palette.setColor(QPalette.Text, Qt.white)
+    palette.setColor(QPalette.Button, QColor(53, 53, 53))
+    palette.setColor(QPalette.ButtonText, Qt.white)
+    palette.setColor(QPalette.BrightText, Qt.red)
+    palette.setColor(QPalette.Link, QColor(42, 130, 218))
+    palette.setColor(QPalette.Highlight, QColor(42, 130, 218))
+    palette.setColor(QPalette.HighlightedText, Qt.black)
+    app.setPalette(palette)
+
+    # finish building window
+    win = Window()
+    win.show()
+    sys.exit(app.exec_())
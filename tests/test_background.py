@@ -0,0 +1,47 @@
+"""With a running average background a flash is a strike for as long as it
+lasts, not until it fades out of the average."""
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+from zapcapture.core import analyze_video
+from zapcapture.options import Options
+
+FRAMES = 120
+SIZE = (64, 48)
+FLASH = range(10, 13)
+THRESHOLD = 100
+
+
+def write_video(path):
+    rng = np.random.default_rng(0)
+    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, SIZE)
+    for number in range(FRAMES):
+        frame = rng.integers(0, 20, (SIZE[1], SIZE[0], 3), dtype=np.uint8)
+        if number in FLASH:
+            frame[:] = 220
+        video.write(frame)
+    video.release()
+
+
+def events(f_in, out_folder, background):
+    os.makedirs(out_folder)
+    analyze_video(f_in, out_folder, THRESHOLD,
+                  options=Options(background=background))
+    f_out = os.path.join(out_folder, os.path.basename(f_in))
+    with open(f_out + '.strikes.json') as f:
+        return json.load(f)['events']
+
+
+def test_average_background_ends_with_the_flash(tmp_path):
+    f_in = str(tmp_path / 'storm.avi')
+    write_video(f_in)
+    previous = events(f_in, str(tmp_path / 'previous'), 'previous')
+    average = events(f_in, str(tmp_path / 'average'), 'average')
+    assert len(average) == len(previous) == 1
+    assert average[0]['start'] == FLASH[0]
+    # the deadzone runs a few frames past the flash, no more
+    assert average[0]['end'] <= previous[0]['end']
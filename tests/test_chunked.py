@@ -0,0 +1,63 @@
+"""A video split into frame ranges across processes gives a sequential run's
+strikes, diffs and output names, even with flashes on the range bounds."""
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+from zapcapture.core import CHUNK_MIN_FRAMES, analyze_video
+from zapcapture.options import Options
+
+WORKERS = 3
+FRAMES = WORKERS*CHUNK_MIN_FRAMES + 1
+SIZE = (64, 48)
+# loop indexes 0 to FRAMES-2 split at CHUNK_MIN_FRAMES and twice that. A
+# flash on frame f shows in the diffs of loop indexes f-1 and f, so these
+# put flashes on, just before and just after each bound.
+FLASHES = [10, CHUNK_MIN_FRAMES - 1, CHUNK_MIN_FRAMES, CHUNK_MIN_FRAMES + 1,
+           2*CHUNK_MIN_FRAMES - 2, 2*CHUNK_MIN_FRAMES + 1, FRAMES - 1]
+THRESHOLD = 100
+
+
+def write_video(path):
+    rng = np.random.default_rng(0)
+    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, SIZE)
+    for number in range(FRAMES):
+        frame = rng.integers(0, 20, (SIZE[1], SIZE[0], 3), dtype=np.uint8)
+        if number in FLASHES:
+            frame[:] = 220
+        video.write(frame)
+    video.release()
+
+
+def analyze(f_in, out_folder, workers):
+    os.makedirs(out_folder)
+    result = analyze_video(f_in, out_folder, THRESHOLD, workers=workers,
+                           options=Options())
+    f_out = os.path.join(out_folder, os.path.basename(f_in))
+    with open(f_out + '.strikes.json') as f:
+        events = json.load(f)['events']
+    return {'strikes': result['strikes'],
+            'diffs': np.load(f_out + '.npy'),
+            'frames': sorted(os.listdir(os.path.join(out_folder, 'frames'))),
+            'clips': sorted(os.listdir(os.path.join(out_folder, 'gifs'))),
+            'events': events}
+
+
+def test_chunks_match_sequential(tmp_path):
+    f_in = str(tmp_path / 'storm.avi')
+    write_video(f_in)
+    sequential = analyze(f_in, str(tmp_path / 'sequential'), 1)
+    chunked = analyze(f_in, str(tmp_path / 'chunked'), WORKERS)
+    assert len(sequential['diffs']) == FRAMES - 1
+    np.testing.assert_array_equal(chunked['diffs'], sequential['diffs'])
+    assert chunked['strikes'] == sequential['strikes'] > 0
+    assert chunked['frames'] == sequential['frames']
+    assert chunked['clips'] == sequential['clips']
+    assert chunked['events'] == sequential['events']
+    # every flash frame was saved
+    saved = {number for event in sequential['events']
+             for number in range(event['start'], event['end'] + 1)}
+    assert set(FLASHES) <= saved
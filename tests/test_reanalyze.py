@@ -0,0 +1,59 @@
+"""Reanalyzing from the diff index of a coarse scan at a lower threshold finds
+what a fresh scan at that threshold does, not just what the coarse counts
+show."""
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+from zapcapture.core import analyze_video
+from zapcapture.options import Options
+
+FRAMES = 120
+SIZE = (128, 96)
+FLASHES = [20, 90]
+# 4x4 spots on an 8 pixel grid shrink to about half their count at a scan
+# scale of 0.25, under LOW but over half of it, so only a scan run for LOW
+# looks at them closely.
+SPOTS = [50, 70]
+SCAN_SCALE = 0.25
+HIGH = 2000
+LOW = 1000
+
+
+def write_video(path):
+    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, SIZE)
+    for number in range(FRAMES):
+        frame = np.full((SIZE[1], SIZE[0], 3), 3, np.uint8)
+        if number in FLASHES:
+            frame[:] = 220
+        if number in SPOTS:
+            for y in range(5, SIZE[1] - 6, 8):
+                for x in range(5, SIZE[0] - 6, 8):
+                    frame[y:y + 4, x:x + 4] = 200
+        video.write(frame)
+    video.release()
+
+
+def analyze(f_in, out_folder, threshold, reanalyze=False):
+    os.makedirs(out_folder, exist_ok=True)
+    result = analyze_video(f_in, out_folder, threshold, options=Options(
+        two_pass=True, scan_scale=SCAN_SCALE, reanalyze=reanalyze))
+    f_out = os.path.join(out_folder, os.path.basename(f_in))
+    with open(f_out + '.strikes.json') as f:
+        events = json.load(f)['events']
+    return result['strikes'], events
+
+
+def test_reanalyze_lower_threshold_matches_fresh_scan(tmp_path):
+    f_in = str(tmp_path / 'storm.avi')
+    write_video(f_in)
+    out_folder = str(tmp_path / 'reanalyzed')
+    high = analyze(f_in, out_folder, HIGH)[0]
+    reanalyzed = analyze(f_in, out_folder, LOW, reanalyze=True)
+    fresh = analyze(f_in, str(tmp_path / 'fresh'), LOW)
+    assert reanalyzed == fresh
+    # the spots are only strikes at the lower threshold
+    assert fresh[0] > high
@@ -0,0 +1,61 @@
+"""ZapCapture lightning detection, usable without the GUI.
+
+Run ``python -m zapcapture --help`` for the command line interface.
+"""
+
+from zapcapture.core import (
+    AnalysisError,
+    DEFAULT_THRESHOLD,
+    StrikeTracker,
+    analyze_folder,
+    analyze_video,
+    analyze_video_two_pass,
+    folder_inputs,
+    plan_strikes,
+    reanalyze_video,
+    scan_diffs,
+    sweep_thresholds,
+)
+from zapcapture.diff import DiffEngine, count_diff
+from zapcapture.events import EventLog, load_strikes
+from zapcapture.index import load_index, save_index
+from zapcapture.manifest import MANIFEST_NAME, Manifest
+from zapcapture.mask import input_mask
+from zapcapture.options import Options
+from zapcapture.stats import REPORT_NAME, StageTimer, load_report, summary
+from zapcapture.threshold import RollingThreshold, frame_thresholds
+from zapcapture.watch import CameraStream, watch_folder
+
+__version__ = "2"
+
+__all__ = [
+    'AnalysisError',
+    'CameraStream',
+    'DEFAULT_THRESHOLD',
+    'DiffEngine',
+    'EventLog',
+    'MANIFEST_NAME',
+    'Manifest',
+    'Options',
+    'REPORT_NAME',
+    'RollingThreshold',
+    'StageTimer',
+    'StrikeTracker',
+    'analyze_folder',
+    'analyze_video',
+    'analyze_video_two_pass',
+    'count_diff',
+    'folder_inputs',
+    'frame_thresholds',
+    'input_mask',
+    'load_index',
+    'load_report',
+    'load_strikes',
+    'plan_strikes',
+    'reanalyze_video',
+    'save_index',
+    'scan_diffs',
+    'summary',
+    'sweep_thresholds',
+    'watch_folder',
+]
@@ -0,0 +1,324 @@
+"""Command line entry point: python -m zapcapture IN_FOLDER OUT_FOLDER"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from zapcapture.core import (
+    AnalysisError,
+    DEFAULT_THRESHOLD,
+    analyze_folder,
+    check_settings,
+    folder_inputs,
+    sweep_thresholds,
+)
+from zapcapture.clips import CLIP_ENCODERS, CLIP_FORMATS, CLIP_MODES
+from zapcapture.decode import DECODERS
+from zapcapture.index import FAST_RATE, FAST_SIZE
+from zapcapture.mask import parse_polygon
+from zapcapture.options import Options
+from zapcapture.watch import watch_folder
+from zapcapture.stats import REPORT_NAME, load_report, summary
+from zapcapture.threshold import AUTO_FRACTION
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='zapcapture',
+        description='Extracts lightning strikes from a folder of videos.')
+    parser.add_argument('input_folder', help='folder of videos to analyze')
+    parser.add_argument('output_folder',
+                        help='folder for the diffs, frames and gifs')
+    parser.add_argument('-t', '--threshold', type=int, default=None,
+                        help='changed pixel count that counts as a strike '
+                             '(default %d, or 0 with --threshold-fraction)'
+                             % DEFAULT_THRESHOLD)
+    parser.add_argument('--threshold-fraction', type=float, metavar='F',
+                        help='threshold as a fraction of the pixels '
+                             'analyzed, eg. 0.01, the same at any resolution')
+    parser.add_argument('--adaptive', type=float, metavar='K',
+                        help='raise the threshold to the median of the '
+                             'recent diffs plus K times their median '
+                             'absolute deviation; the threshold becomes the '
+                             'floor, by default --threshold-fraction %g. 6 '
+                             'is a good start' % AUTO_FRACTION)
+    parser.add_argument('--adaptive-window', type=int,
+                        default=Options.threshold_window, metavar='FRAMES',
+                        help='recent diffs for --adaptive '
+                             '(default %(default)s)')
+    parser.add_argument('--timestamp', action='store_true',
+                        help='name output files by timestamp instead of '
+                             'frame number')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes, 0 for one per cpu. '
+                             'Videos are spread across them, or long videos '
+                             'are split into frame ranges when there are '
+                             'fewer videos than workers (default %(default)s)')
+    parser.add_argument('--gray-diff', action='store_true',
+                        help='diff frames in grayscale; faster, slightly '
+                             'different counts')
+    parser.add_argument('--two-pass', action='store_true',
+                        help='scan for the diff series first, then seek to '
+                             'the strikes to write images and clips')
+    parser.add_argument('--scan-scale', type=float, default=Options.scan_scale,
+                        help='downscale for the two pass scan '
+                             '(default %(default)s), implies --two-pass')
+    parser.add_argument('--scan-stride', type=int, default=Options.scan_stride,
+                        help='only diff every k-th frame in the two pass scan '
+                             'until something happens, implies --two-pass')
+    parser.add_argument('--scan-pixels', type=parse_size, metavar='WxH',
+                        help='pick the two pass scan downscale per video to '
+                             'shrink frames to about this size, eg. 320x180, '
+                             'implies --two-pass')
+    parser.add_argument('--scan-rate', type=float, metavar='FPS',
+                        help='pick the two pass scan stride per video to take '
+                             'about this many diffs a second, implies '
+                             '--two-pass')
+    parser.add_argument('--fast', action='store_true',
+                        help='scan at about %dx%d and %d diffs a second until '
+                             'something happens, then at full rate and '
+                             'resolution. Same as --scan-pixels %dx%d '
+                             '--scan-rate %d. Saves diffing quiet footage, '
+                             'not decoding it' % ((FAST_SIZE + (FAST_RATE,))*2))
+    parser.add_argument('--mask', metavar='PNG',
+                        help='image of the area to analyze, white analyzed '
+                             'and black ignored. A video with its own '
+                             '<name>.mask.png uses that instead')
+    parser.add_argument('--exclude', action='append', metavar='"X,Y X,Y X,Y"',
+                        type=parse_polygon,
+                        help='polygon of frame pixels to leave out, eg. a '
+                             'timestamp or a road. Can be repeated')
+    parser.add_argument('--background', choices=['previous', 'average'],
+                        default=Options.background,
+                        help='compare each frame with the previous one, or '
+                             'with a running average of the frames before '
+                             'it (default %(default)s)')
+    parser.add_argument('--background-alpha', type=float,
+                        default=Options.background_alpha,
+                        help='how far the average background moves towards '
+                             'each frame (default %(default)s)')
+    parser.add_argument('--reanalyze', action='store_true',
+                        help='reuse the diff index saved by an earlier run '
+                             'instead of decoding the videos again')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip videos already analyzed with the same '
+                             'settings, and carry on stopped videos from '
+                             'their last checkpoint')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and analyze new videos as they '
+                             'are written, carrying strikes across '
+                             'consecutive segments of a camera. Stop with '
+                             'ctrl+c')
+    parser.add_argument('--camera-pattern', default=Options.camera_pattern,
+                        metavar='REGEX',
+                        help='for --watch, matches a file name without its '
+                             'extension, the first group naming the camera '
+                             '(default %(default)s)')
+    parser.add_argument('--sweep', metavar='T1,T2,...',
+                        help='print what each threshold would detect, using '
+                             'the diff index, without writing frames')
+    parser.add_argument('--pre-trigger', type=int, default=Options.pre_trigger,
+                        help='frames from before each strike to start its '
+                             'clip with (default %(default)s)')
+    parser.add_argument('--clip-memory', type=int, default=Options.clip_memory,
+                        metavar='BYTES',
+                        help='memory allowed for pre-trigger frames; fewer '
+                             'are kept for large videos (default %(default)s)')
+    parser.add_argument('--clip-mode', choices=CLIP_MODES,
+                        default=Options.clip_mode,
+                        help='encode clips from the decoded frames, copy '
+                             'them straight out of the video with ffmpeg '
+                             '(from the keyframe before each strike, at '
+                             'original quality and almost no cpu), or copy '
+                             'but re-encode clips not starting on a '
+                             'keyframe (exact) (default %(default)s)')
+    parser.add_argument('--clip-encoder', choices=CLIP_ENCODERS,
+                        default=Options.clip_encoder,
+                        help='encoder for --clip-mode encode; ffmpeg can '
+                             'also write gif and webp (default %(default)s)')
+    parser.add_argument('--clip-format', choices=CLIP_FORMATS,
+                        default=Options.clip_format)
+    parser.add_argument('--clip-codec', metavar='NAME',
+                        help='ffmpeg encoder for clips, eg. libx265 or '
+                             'h264_nvenc')
+    parser.add_argument('--clip-quality', type=int,
+                        help='ffmpeg crf for mp4 clips, or webp quality '
+                             '0-100')
+    parser.add_argument('--clip-fps', type=float, default=Options.clip_fps,
+                        help='frame rate clips are encoded at, 0 for the '
+                             "video's own (default %(default)s)")
+    parser.add_argument('--decoder', choices=DECODERS,
+                        default=Options.decoder,
+                        help='video decoder. ffmpeg needs ffmpeg on the PATH '
+                             'and pyav the av package; both shrink and gray '
+                             'frames while decoding for the two pass scan. '
+                             'ffmpeg is the slowest at full size, so only '
+                             'use it with --fast or --two-pass '
+                             '(default %(default)s)')
+    parser.add_argument('--decode-threads', type=int,
+                        default=Options.decode_threads,
+                        help="the decoder's own threads, 0 for its default")
+    parser.add_argument('--hw-decode', action='store_true',
+                        help='decode on the graphics card where the decoder '
+                             'supports it')
+    parser.add_argument('--prefetch', type=int, default=Options.prefetch,
+                        help='frames decoded ahead on a background thread, '
+                             '0 decodes inline (default %(default)s)')
+    parser.add_argument('--write-threads', type=int,
+                        default=Options.write_threads,
+                        help='background threads writing images, 0 writes '
+                             'inline (default %(default)s)')
+    parser.add_argument('--strike-table', choices=['json', 'parquet'],
+                        default=Options.strike_table,
+                        help='format of the table of strike events saved '
+                             'for each video; parquet needs pyarrow '
+                             '(default %(default)s)')
+    parser.add_argument('--csv', action='store_true',
+                        help='also write the diff of every frame to '
+                             '<video>.csv, as the GUI used to')
+    parser.add_argument('--image-format', choices=['png', 'jpg', 'webp'],
+                        default=Options.image_format)
+    parser.add_argument('--image-quality', type=int, default=None,
+                        help='png compression 0-9, or jpg/webp quality 0-100')
+    parser.add_argument('--profile', action='store_true',
+                        help='run each video under cProfile and save '
+                             '<video>.prof in the output folder')
+    parser.add_argument('-p', '--progress', action='store_true',
+                        help='show a progress percentage on stderr')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the time spent in each stage, write '
+                             'statistics and the total run time')
+    return parser
+
+
+def parse_size(text):
+    '''Parses "320x180" into a pixel count.'''
+    width, height = text.lower().split('x')
+    return int(width)*int(height)
+
+
+def build_options(args):
+    if args.fast:
+        args.scan_pixels = args.scan_pixels or FAST_SIZE[0]*FAST_SIZE[1]
+        args.scan_rate = args.scan_rate or FAST_RATE
+    two_pass = (args.two_pass or args.scan_scale != Options.scan_scale
+                or args.scan_stride != Options.scan_stride
+                or args.scan_pixels is not None or args.scan_rate is not None)
+    return Options(threshold_fraction=args.threshold_fraction,
+                   threshold_k=args.adaptive,
+                   threshold_window=args.adaptive_window,
+                   gray_diff=args.gray_diff, two_pass=two_pass,
+                   scan_scale=args.scan_scale, scan_stride=args.scan_stride,
+                   scan_pixels=args.scan_pixels, scan_rate=args.scan_rate,
+                   reanalyze=args.reanalyze, pre_trigger=args.pre_trigger,
+                   clip_memory=args.clip_memory,
+                   clip_mode=args.clip_mode, clip_encoder=args.clip_encoder,
+                   clip_format=args.clip_format, clip_codec=args.clip_codec,
+                   clip_quality=args.clip_quality, clip_fps=args.clip_fps,
+                   decoder=args.decoder,
+                   decode_threads=args.decode_threads,
+                   hw_decode=args.hw_decode,
+                   prefetch=args.prefetch,
+                   write_threads=args.write_threads,
+                   strike_table=args.strike_table, csv=args.csv,
+                   image_format=args.image_format,
+                   image_quality=args.image_quality,
+                   profile=args.profile,
+                   resume=args.resume,
+                   camera_pattern=args.camera_pattern,
+                   mask=args.mask, exclude=args.exclude,
+                   background=args.background,
+                   background_alpha=args.background_alpha)
+
+
+def sweep(args, options):
+    thresholds = [int(value) for value in args.sweep.split(',')]
+    check_settings(args.input_folder, args.output_folder, options)
+    print('file, threshold, strikes, images, clips')
+    for f_in in folder_inputs(args.input_folder):
+        results = sweep_thresholds(f_in, args.output_folder, thresholds,
+                                   options)
+        for result in results or []:
+            print('%s, %d, %d, %d, %d' % (
+                f_in, result['threshold'], result['strikes'],
+                result['images'], result['clips']))
+
+
+def watch(args, options):
+    def finished(f_in, result):
+        if result is not None:
+            print('%s: %d strikes' % (f_in, result['strikes']))
+
+    print('Watching %s, ctrl+c to stop' % args.input_folder)
+    try:
+        watch_folder(args.input_folder, args.output_folder, args.threshold,
+                     name_by_frame=not args.timestamp,
+                     workers=args.jobs, options=options, finished=finished)
+    except KeyboardInterrupt:
+        # the lanes finish their segment and clips on the way out
+        pass
+
+
+def print_progress(value):
+    sys.stderr.write('\r%5.1f%%' % value)
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if (args.adaptive is not None and args.threshold is None
+            and args.threshold_fraction is None and not args.sweep):
+        # a floor of 0 lets the adaptive threshold fall to the noise, so it
+        # gets the same floor as the gui's automatic threshold
+        args.threshold_fraction = AUTO_FRACTION
+    if args.threshold is None:
+        # a relative threshold only needs the pixel count as a floor
+        relative = (args.threshold_fraction is not None
+                    or args.adaptive is not None)
+        args.threshold = 0 if relative else DEFAULT_THRESHOLD
+    start = time.perf_counter()
+    progress = print_progress if args.progress else None
+    options = build_options(args)
+    if args.sweep or args.watch:
+        try:
+            if args.sweep:
+                sweep(args, options)
+            else:
+                watch(args, options)
+        except AnalysisError as e:
+            print(e, file=sys.stderr)
+            return 2
+        return 0
+    try:
+        results = analyze_folder(args.input_folder, args.output_folder,
+                                 args.threshold,
+                                 name_by_frame=not args.timestamp,
+                                 progress=progress,
+                                 workers=args.jobs,
+                                 options=options)
+    except AnalysisError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.progress:
+        sys.stderr.write('\n')
+    strikes = sum(result['strikes'] for result in results)
+    skipped = sum(1 for result in results if result.get('skipped'))
+    print('Videos: %d Strikes: %d' % (len(results), strikes))
+    if skipped:
+        print('Already done: %d' % skipped)
+    if args.verbose:
+        for result in results:
+            if 'writes' in result:
+                print(result['file'], result['writes'])
+        # the stage times of the whole run, from the saved run report
+        print(summary(load_report(os.path.join(args.output_folder,
+                                               REPORT_NAME))))
+        print('Total Time: %.1f s' % (time.perf_counter() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,366 @@
+"""Benchmarks for ZapCapture.
+
+python -m zapcapture.benchmark diff    times count_diff against DiffEngine
+python -m zapcapture.benchmark decode  times each available decoder on the
+                                       same video
+python -m zapcapture.benchmark suite   runs the analysis over synthetic
+                                       storm videos and reports json
+
+The suite writes its own footage: noisy frames under a slowly changing
+light level, with flashes of known timing and brightness injected. It
+reports throughput, time per stage, peak memory and how well the injected
+flashes were found, so results can be compared between versions.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from zapcapture import __version__
+from zapcapture.core import analyze_video, plan_strikes
+from zapcapture.decode import (
+    DECODERS,
+    decoded_format,
+    decoder_available,
+    open_video,
+)
+from zapcapture.diff import SCALE, DiffEngine, count_diff
+from zapcapture.index import FAST_RATE, FAST_SIZE
+from zapcapture.options import Options
+
+try:
+    import resource
+except ImportError:
+    # not on windows; peak memory is reported as None there
+    resource = None
+
+# frames held in memory for the diff benchmark
+DIFF_FRAMES = 60
+# synthetic storm footage
+SUITE_SIZES = ['640x360', '1280x720', '1920x1080']
+SUITE_FRAMES = [300]
+SUITE_FPS = 30
+# frames between the starts of two injected flashes, at least
+FLASH_SPACING = 40
+# share of the (downscaled) frame that has to change for a strike
+SUITE_THRESHOLD = 0.3
+
+
+def random_frames(width, height, count, seed=0):
+    '''Returns a (count, height, width, 3) stack of noisy frames.'''
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 40, (count, height, width, 3), dtype=np.uint8)
+
+
+def diff_benchmark(width, height, count=DIFF_FRAMES, repeat=3, batch=8):
+    """Times the diff of count frames of the given size, in frames/sec.
+
+    Returns a dict with the rate of the original count_diff and of
+    DiffEngine in its color, gray and batch modes. Best of repeat runs.
+    """
+    frames = random_frames(width, height, count)
+
+    def original():
+        for i in range(count - 1):
+            count_diff(frames[i], frames[i + 1])
+
+    def engine(gray):
+        def run():
+            diff_engine = DiffEngine(gray=gray)
+            for frame in frames:
+                diff_engine.push(frame)
+        return run
+
+    def batched():
+        diff_engine = DiffEngine()
+        for start in range(0, count, batch):
+            diff_engine.push_batch(frames[start:start + batch])
+
+    rates = {}
+    for name, run in [('count_diff', original), ('engine', engine(False)),
+                      ('engine_gray', engine(True)), ('engine_batch', batched)]:
+        best = min(_timed(run) for _ in range(repeat))
+        rates[name] = count/best
+    return {'width': width, 'height': height, 'frames': count,
+            'frames_per_sec': rates}
+
+
+def decode_benchmark(path, decoders=DECODERS, repeat=2):
+    """Times reading a video with each decoder, in frames/sec.
+
+    Each available decoder reads every frame at full size, grabs every
+    frame without converting it, and reads every frame the way the two
+    pass scan asks for them: at SCALE, gray. Decoders that can't shrink
+    frames themselves are timed with the resize the DiffEngine would do.
+    Unavailable decoders get None. Best of repeat runs.
+    """
+    probe = cv2.VideoCapture(path)
+    frames = int(probe.get(cv2.CAP_PROP_FRAME_COUNT))
+    probe.release()
+
+    def reading(name, scale=1.0, gray=False, grab=False):
+        def run():
+            video = open_video(path, Options(decoder=name), scale, gray)
+            engine = None
+            if decoded_format(video)[0] != scale:
+                engine = DiffEngine(scale=scale, gray=gray)
+            buffer = None
+            while True:
+                if grab:
+                    if not video.grab():
+                        break
+                    continue
+                flag, buffer = video.read(image=buffer)
+                if not flag:
+                    break
+                if engine is not None:
+                    engine.shrink(buffer)
+            video.release()
+        return run
+
+    results = {}
+    for name in decoders:
+        if not decoder_available(name):
+            results[name] = None
+            continue
+        rates = {}
+        for mode, run in [('read', reading(name)),
+                          ('grab', reading(name, grab=True)),
+                          ('scan', reading(name, SCALE, True))]:
+            best = min(_timed(run) for _ in range(repeat))
+            rates[mode] = round(frames/best, 1)
+        results[name] = rates
+    return {'video': path, 'frames': frames, 'frames_per_sec': results}
+
+
+def _timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def synthetic_storm(path, width, height, frames, fps=SUITE_FPS, seed=0):
+    """Writes a synthetic storm video and returns its injected flashes.
+
+    The sky is dark noise under a light level that drifts slowly, like
+    passing cloud or dusk. Flashes of 1 to 6 frames and random brightness
+    are dropped in at least FLASH_SPACING frames apart. Returns a list of
+    (first frame, frame count, brightness) for the flashes.
+    """
+    rng = np.random.default_rng(seed)
+    # a few noise frames, cycled, are plenty and much faster at 4K
+    noise = rng.integers(0, 12, (8, height, width, 3), dtype=np.uint8)
+    flashes = []
+    start = int(rng.integers(10, FLASH_SPACING))
+    while start < frames - 8:
+        flashes.append((start, int(rng.integers(1, 7)),
+                        int(rng.integers(60, 160))))
+        start = start + FLASH_SPACING + int(rng.integers(0, 3*FLASH_SPACING))
+    brightness = np.zeros(frames, np.int64)
+    for first, count, level in flashes:
+        brightness[first:first + count] = level
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps,
+                             (width, height))
+    frame = np.empty((height, width, 3), np.uint8)
+    for i in range(frames):
+        # drifts between 20 and 50 over a few hundred frames
+        light = 35 + 15*np.sin(i/150.0) + brightness[i]
+        np.add(noise[i % len(noise)], min(int(light), 240), out=frame)
+        writer.write(frame)
+    writer.release()
+    return flashes
+
+
+def score_detection(flashes, clips):
+    """Matches detected clips against injected flashes.
+
+    A flash counts as found if a clip's frames overlap it, give or take a
+    frame; a clip counts as correct if it overlaps any flash. Returns
+    (precision, recall).
+    """
+    spans = [(min(frames), max(frames)) for gif_name, frames in clips if frames]
+    found = 0
+    for first, count, level in flashes:
+        if any(low <= first + count and high >= first - 1
+               for low, high in spans):
+            found = found + 1
+    correct = 0
+    for low, high in spans:
+        if any(low <= first + count and high >= first - 1
+               for first, count, level in flashes):
+            correct = correct + 1
+    precision = correct/len(spans) if spans else 1.0
+    recall = found/len(flashes) if flashes else 1.0
+    return round(precision, 4), round(recall, 4)
+
+
+def run_case(path, flashes, width, height, frames, options, work):
+    """Analyzes one synthetic video and returns its result dict.
+
+    Meant to run in a fresh process so the peak memory is its own.
+    """
+    threshold = int(SUITE_THRESHOLD*width*height*SCALE*SCALE)
+    out_folder = tempfile.mkdtemp(dir=work)
+    start = time.perf_counter()
+    # the analysis reports progress on stdout, which is for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        result = analyze_video(path, out_folder, threshold, options=options)
+    seconds = time.perf_counter() - start
+    diffs = np.load(result['diffs'])
+    images, clips, strikes = plan_strikes(diffs, threshold,
+                                          lambda i: (None, None))
+    precision, recall = score_detection(flashes, clips)
+    peak = None
+    if resource is not None:
+        # kilobytes on linux, bytes on macos
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak/2**20 if sys.platform == 'darwin' else peak/2**10
+    return {'width': width, 'height': height, 'frames': frames,
+            'threshold': threshold, 'seconds': round(seconds, 4),
+            'frames_per_sec': round(frames/seconds, 2),
+            'stages': result['stats']['seconds'],
+            'counts': result['stats']['counts'],
+            'peak_rss_mb': None if peak is None else round(peak, 1),
+            'flashes': len(flashes), 'clips': len(clips),
+            'precision': precision, 'recall': recall}
+
+
+def suite(sizes, lengths, options, work=None):
+    """Runs the analysis over synthetic storms of every size and length.
+
+    Returns a json ready dict with the machine, settings and one result
+    per case. Videos are written to work, or to a temporary folder that is
+    removed afterwards.
+    """
+    if work is None:
+        with tempfile.TemporaryDirectory(prefix='zapbench') as work:
+            return suite(sizes, lengths, options, work)
+    os.makedirs(work, exist_ok=True)
+    cases = []
+    for size in sizes:
+        width, height = (int(value) for value in size.split('x'))
+        for frames in lengths:
+            path = os.path.join(work, 'storm_%s_%d.avi' % (size, frames))
+            flashes = synthetic_storm(path, width, height, frames)
+            # one fresh process per case keeps peak memory separate
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                case = pool.submit(run_case, path, flashes, width, height,
+                                   frames, options, work).result()
+            case['name'] = '%s_%d' % (size, frames)
+            cases.append(case)
+    return {'version': __version__, 'python': platform.python_version(),
+            'opencv': cv2.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count(), 'options': options.as_dict(),
+            'cases': cases}
+
+
+def suite_options(args):
+    if args.fast:
+        return Options(two_pass=True, scan_pixels=FAST_SIZE[0]*FAST_SIZE[1],
+                       scan_rate=FAST_RATE, decoder=args.decoder)
+    return Options(two_pass=args.two_pass, decoder=args.decoder)
+
+
+def decode_storm(work, size, frames, decoders):
+    """Times the decoders over a synthetic storm of size written to work."""
+    width, height = (int(value) for value in size.split('x'))
+    os.makedirs(work, exist_ok=True)
+    path = os.path.join(work, 'storm_%s.avi' % size)
+    synthetic_storm(path, width, height, frames)
+    return decode_benchmark(path, decoders)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='zapcapture.benchmark',
+                                     description='ZapCapture benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    diff = commands.add_parser('diff', help='frame diff micro-benchmark')
+    diff.add_argument('--size', action='append', default=None,
+                      help='frame size as WIDTHxHEIGHT, may be repeated '
+                           '(default 1280x720, 1920x1080 and 3840x2160)')
+    diff.add_argument('--frames', type=int, default=DIFF_FRAMES)
+    diff.add_argument('--json', action='store_true',
+                      help='print results as json')
+    decode = commands.add_parser('decode',
+                                 help='decoder read, grab and scan rates')
+    decode.add_argument('--video', help='video to decode, a synthetic storm '
+                                        'of --size by default')
+    decode.add_argument('--size', default='1920x1080')
+    decode.add_argument('--frames', type=int, default=SUITE_FRAMES[0])
+    decode.add_argument('--decoder', action='append', choices=DECODERS,
+                        help='decoder to time, may be repeated (default all)')
+    decode.add_argument('--work', help='keep the synthetic storm in this '
+                                       'folder instead of a temporary one')
+    storm = commands.add_parser('suite',
+                                help='analysis over synthetic storm videos')
+    storm.add_argument('--sizes', default=','.join(SUITE_SIZES),
+                       help='comma separated WIDTHxHEIGHT list '
+                            '(default %(default)s)')
+    storm.add_argument('--frames', default=','.join(map(str, SUITE_FRAMES)),
+                       help='comma separated video lengths in frames '
+                            '(default %(default)s)')
+    storm.add_argument('--two-pass', action='store_true')
+    storm.add_argument('--decoder', choices=DECODERS,
+                       default=Options.decoder)
+    storm.add_argument('--fast', action='store_true',
+                       help='two pass scan at a small size and stride, see '
+                            'zapcapture --fast')
+    storm.add_argument('--work', help='keep the videos and outputs in this '
+                                      'folder instead of a temporary one')
+    storm.add_argument('--output', help='write the json here instead of '
+                                        'printing it')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'suite':
+        results = suite(args.sizes.split(','),
+                        [int(value) for value in args.frames.split(',')],
+                        suite_options(args), args.work)
+        text = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+        return 0
+    if args.command == 'decode':
+        decoders = args.decoder or DECODERS
+        if args.video is not None:
+            results = decode_benchmark(args.video, decoders)
+        elif args.work is not None:
+            results = decode_storm(args.work, args.size, args.frames,
+                                   decoders)
+        else:
+            with tempfile.TemporaryDirectory(prefix='zapbench') as work:
+                results = decode_storm(work, args.size, args.frames,
+                                       decoders)
+        print(json.dumps(results, indent=2))
+        return 0
+    sizes = args.size or ['1280x720', '1920x1080', '3840x2160']
+    results = []
+    for size in sizes:
+        width, height = (int(value) for value in size.split('x'))
+        result = diff_benchmark(width, height, args.frames)
+        results.append(result)
+        if not args.json:
+            rates = result['frames_per_sec']
+            print('%s: ' % size + '  '.join(
+                '%s %.1f fps' % (name, rate) for name, rate in rates.items()))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""Strike clips.
+
+A clip is one deadzone episode: it starts with the strike that opens the
+deadzone, runs until the deadzone closes (or GIF_FRAMES_LIMIT frames), and
+is led in by a few pre-trigger frames from just before the strike. Frames
+are streamed to the encoder as they arrive, so only the pre-trigger frames
+are ever held in memory, in a FrameRing of frame buffers that are reused
+for the whole video.
+
+Options.clip_encoder picks the encoder: opencv's mp4v writer, or an ffmpeg
+process fed raw frames, which can also write gif and webp at any frame
+rate and use any ffmpeg encoder, including hardware ones. With
+Options.clip_mode 'copy' nothing is encoded at all: each clip is cut
+straight out of the source video by ffmpeg, at its original quality. A
+stream copy can only start on a keyframe, so a copied clip leads in from
+the keyframe before its first frame; 'exact' re-encodes the clips that
+don't start on one instead.
+"""
+
+import collections
+import os
+import subprocess
+
+import cv2
+
+from zapcapture.decode import ffmpeg_path
+
+# default memory allowed for pre-trigger frames, in bytes
+CLIP_MEMORY = 256*2**20
+PRE_TRIGGER_FRAMES = 5
+CLIP_FPS = 4.0
+CLIP_MODES = ('encode', 'copy', 'exact')
+CLIP_ENCODERS = ('opencv', 'ffmpeg')
+CLIP_FORMATS = ('mp4', 'gif', 'webp')
+# ffmpeg output settings of each clip format. gif makes its own palette.
+_FORMAT_ARGS = {
+    'mp4': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+    'gif': ['-vf', 'split[a][b];[a]palettegen[p];[b][p]paletteuse',
+            '-loop', '0'],
+    'webp': ['-c:v', 'libwebp_anim', '-loop', '0'],
+}
+# the ffmpeg option clip_quality sets for each format
+_QUALITY_ARGS = {'mp4': '-crf', 'webp': '-quality'}
+
+
+def pre_trigger_count(width, height, options):
+    '''Pre-trigger frames to keep, limited by options.clip_memory.'''
+    frame_bytes = max(width*height*3, 1)
+    return max(0, min(int(options.pre_trigger), options.clip_memory//frame_bytes))
+
+
+def clip_rate(options, fps):
+    '''The frame rate clips are encoded at, for a video of fps.'''
+    return options.clip_fps or fps
+
+
+def clip_extension(options, f_in):
+    '''The clip file extension, the source's own when clips are copied.'''
+    if options.clip_mode != 'encode':
+        return os.path.splitext(f_in)[1] or '.mp4'
+    return '.' + options.clip_format
+
+
+class FrameRing:
+    """Holds the last capacity frames.
+
+    The ring keeps the frames themselves rather than copies; push() hands
+    back the frame that dropped out, so with a FrameReader the same few
+    buffers cycle through the reader and the ring without new allocations.
+    Each frame can carry a source, its (video, frame number), for clips
+    cut from the video; items() gives them back with the frames.
+    """
+
+    def __init__(self, capacity):
+        self.frames = collections.deque()
+        self.sources = collections.deque()
+        self.capacity = capacity
+
+    def push(self, frame, source=None):
+        '''Adds frame, returns the frame dropped to make room, or None.'''
+        if self.capacity == 0:
+            return frame
+        self.frames.append(frame)
+        self.sources.append(source)
+        if len(self.frames) > self.capacity:
+            self.sources.popleft()
+            return self.frames.popleft()
+        return None
+
+    def items(self):
+        '''(frame, source) pairs, oldest first.'''
+        return zip(self.frames, self.sources)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        # oldest first
+        return iter(self.frames)
+
+
+def open_clip(gif_name, size, fps=CLIP_FPS, options=None):
+    """Opens a writer for a clip of frames of the given (w, h) size.
+
+    opencv's mp4v writer unless options.clip_encoder is 'ffmpeg'. Either
+    way it has write(frame) and release().
+    """
+    if options is not None and options.clip_encoder == 'ffmpeg':
+        return FFmpegClipWriter(gif_name, size, fps, options)
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    return cv2.VideoWriter(gif_name, fourcc, fps, size)
+
+
+def encode_args(options, extension):
+    '''ffmpeg output settings for a clip written to a file of extension.'''
+    clip_format = extension.lstrip('.').lower()
+    if clip_format in ('mov', 'mkv', 'm4v'):
+        clip_format = 'mp4'
+    args = list(_FORMAT_ARGS.get(clip_format, []))
+    if options.clip_codec:
+        args += ['-c:v', options.clip_codec]
+    if options.clip_quality is not None and clip_format in _QUALITY_ARGS:
+        args += [_QUALITY_ARGS[clip_format], str(options.clip_quality)]
+    return args
+
+
+def _ffmpeg(args):
+    # runs ffmpeg to completion, raising OSError with its message if it fails
+    result = subprocess.run([ffmpeg_path(), '-nostdin', '-y', '-loglevel',
+                             'error'] + args, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise OSError('ffmpeg failed: '
+                      + result.stderr.decode(errors='replace').strip())
+
+
+class FFmpegClipWriter:
+    """Encodes a clip with an ffmpeg process, fed raw frames on its stdin.
+
+    The format comes from the file extension, with options.clip_codec and
+    options.clip_quality on top, see encode_args.
+    """
+
+    def __init__(self, path, size, fps, options):
+        self.path = path
+        command = [ffmpeg_path(), '-nostdin', '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                   '-s', '%dx%d' % tuple(size), '-r', str(fps), '-i', '-']
+        command += encode_args(options, os.path.splitext(path)[1])
+        self.process = subprocess.Popen(command + [path],
+                                        stdin=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(memoryview(frame).cast('B'))
+        except BrokenPipeError:
+            # ffmpeg gave up, release() says why
+            pass
+
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        message = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise OSError('ffmpeg could not write ' + self.path + ': '
+                          + message.decode(errors='replace').strip())
+
+
+def add_source(pieces, source):
+    '''Adds a (video, frame number) to a clip's [video, first, last] pieces.'''
+    f_in, number = source
+    if pieces and pieces[-1][0] == f_in and pieces[-1][2] + 1 == number:
+        pieces[-1][2] = number
+    else:
+        pieces.append([f_in, number, number])
+
+
+def _source_fps(f_in):
+    video = cv2.VideoCapture(f_in)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    return fps
+
+
+def starts_on_keyframe(f_in, number, fps):
+    """True if a stream copy from frame number starts at that frame.
+
+    Asks ffmpeg for the first packet a copy would take, without decoding
+    anything: it is the keyframe at or before the frame, timed relative
+    to it.
+    """
+    result = subprocess.run(
+        [ffmpeg_path(), '-nostdin', '-loglevel', 'error',
+         '-ss', '%.6f' % (number/fps), '-i', f_in, '-map', '0:v:0',
+         '-c', 'copy', '-frames:v', '1', '-f', 'framecrc', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    lines = result.stdout.decode(errors='replace').splitlines()
+    base = [line for line in lines if line.startswith('#tb')]
+    packets = [line for line in lines if line and not line.startswith('#')]
+    if not base or not packets:
+        return False
+    numerator, denominator = base[0].split(':')[1].split('/')
+    pts = int(packets[0].split(',')[2])
+    # within half a frame of the seek
+    return pts*int(numerator)/int(denominator) > -0.5/fps
+
+
+def _cut(path, f_in, first, last, fps, options, encode):
+    command = ['-ss', '%.6f' % (first/fps), '-i', f_in, '-map', '0:v:0']
+    if encode:
+        # decoding from the seek is frame exact
+        command += ['-frames:v', str(last - first + 1)]
+        command += encode_args(options, os.path.splitext(path)[1])
+    else:
+        command += ['-t', '%.6f' % ((last - first + 1)/fps), '-c', 'copy']
+    _ffmpeg(command + [path])
+
+
+def cut_clip(path, pieces, options):
+    """Writes a clip by cutting its frames out of the source videos.
+
+    pieces are [video, first, last] frame ranges, in order; a clip that
+    crosses from one watched segment into the next has one per segment,
+    cut separately and joined. The video streams are copied, so nothing is
+    decoded, except with options.clip_mode 'exact' when the clip doesn't
+    start on a keyframe: then it is re-encoded from its first frame.
+    Returns the bytes written.
+    """
+    rates = [_source_fps(piece[0]) for piece in pieces]
+    encode = options.clip_mode == 'exact' and not starts_on_keyframe(
+        pieces[0][0], pieces[0][1], rates[0])
+    if len(pieces) == 1:
+        _cut(path, *pieces[0], rates[0], options, encode)
+        return os.path.getsize(path)
+    root, extension = os.path.splitext(path)
+    parts = ['%s.part%d%s' % (root, k, extension) for k in range(len(pieces))]
+    listing = root + '.parts.txt'
+    try:
+        for part, piece, fps in zip(parts, pieces, rates):
+            # the parts are joined as they are, so they all need encoding
+            # the same way
+            _cut(part, *piece, fps, options, encode)
+        with open(listing, 'w') as f:
+            f.writelines("file '%s'\n" % os.path.abspath(part).replace(
+                "'", "'\\''") for part in parts)
+        _ffmpeg(['-f', 'concat', '-safe', '0', '-i', listing, '-c', 'copy',
+                 path])
+    finally:
+        for name in parts + [listing]:
+            if os.path.exists(name):
+                os.remove(name)
+    return os.path.getsize(path)
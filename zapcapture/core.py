@@ -0,0 +1,1101 @@
+"""Headless lightning detection core.
+
+Everything in here runs without Qt or tkinter so that ZapCapture can be
+scripted or run from cron on machines without a display. The GUI worker in
+LightningGUI.py is a thin wrapper around analyze_folder.
+"""
+
+import contextlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+from zapcapture.clips import (
+    CLIP_ENCODERS,
+    CLIP_FPS,
+    FrameRing,
+    clip_extension,
+    clip_rate,
+    pre_trigger_count,
+)
+from zapcapture.decode import (
+    DECODERS,
+    decode_threads_available,
+    decoded_format,
+    decoder_available,
+    ffmpeg_path,
+    open_video,
+)
+from zapcapture.diff import SCALE, DiffEngine
+from zapcapture.events import (
+    EventLog,
+    events_path,
+    save_events,
+    table_available,
+)
+from zapcapture.index import (
+    background_key,
+    load_index,
+    save_index,
+    scan_plan,
+    scan_settings,
+)
+from zapcapture.manifest import (
+    Manifest,
+    clear_checkpoint,
+    load_checkpoint,
+    run_params,
+    save_checkpoint,
+    series_path,
+)
+from zapcapture.mask import MASK_SUFFIX, input_mask, read_mask
+from zapcapture.options import Options
+from zapcapture.reader import FrameReader, every_frame, strided
+from zapcapture.stats import (
+    REPORT_NAME,
+    StageTimer,
+    profile_call,
+    save_report,
+    totals,
+)
+from zapcapture.threshold import (
+    base_threshold,
+    frame_thresholds,
+    rolling_threshold,
+)
+from zapcapture.writer import OutputWriter, image_extension
+
+# global constants
+END_STRIKE_PERCENTAGE = .9
+GIF_FRAMES_LIMIT = 100
+DEFAULT_THRESHOLD = 5000000
+# shortest frame range worth giving its own process when splitting a video
+CHUNK_MIN_FRAMES = 500
+# fraction of the threshold at which a strided scan goes back to every frame
+REFINE_LEVEL = 0.5
+# csv rows written at a time
+CSV_BATCH = 1000
+# seconds between checkpoints of a sequential analysis
+CHECKPOINT_SECONDS = 60
+
+
+class AnalysisError(Exception):
+    '''Raised when an analysis can not be started, eg. a bad folder.'''
+
+
+def output_dirs(out_folder):
+    '''Creates the frame and gif directories, returns their paths.'''
+    impath = os.path.join(out_folder, 'frames/')
+    gifpath = os.path.join(out_folder, 'gifs/')
+    if not os.path.isdir(impath):
+        os.mkdir(impath)
+    if not os.path.isdir(gifpath):
+        os.mkdir(gifpath)
+    return impath, gifpath
+
+
+def output_names(impath, gifpath, filename, i, fps, name_by_frame=True,
+                 extension='.png', gif_extension='.mp4'):
+    '''Returns the frame and clip file names for loop index i.'''
+    # filename has had its periods replaced already.
+    if not name_by_frame:
+        timestamp = str(round(int(i)/int(fps), 2)).replace('.', '-')
+        imname = impath + '/' + str(filename) + str(timestamp) + extension
+        gifname = (gifpath + '/' + str(filename) + str(timestamp)
+                   + gif_extension)
+    else:
+        imname = impath + str(filename) + "_%06d" % i + extension
+        gifname = gifpath + str(filename) + "_%06d" % i + gif_extension
+    return imname, gifname
+
+
+def video_info(video):
+    '''Returns frame count, width, height and fps of an open video.'''
+    nframes = (int)(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    width = (int)(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = (int)(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = (int)(video.get(cv2.CAP_PROP_FPS))
+    return nframes, width, height, fps
+
+
+def diff_engine(options, mask=None, scale=SCALE):
+    '''The DiffEngine for options, counting inside mask (see input_mask).'''
+    return DiffEngine(scale=scale, gray=options.gray_diff, mask=mask,
+                      average=background_key(options))
+
+
+class StrikeTracker:
+    """The deadzone state machine that decides which frames are strikes.
+
+    Feed it the diff of every frame in order with update(). It only looks at
+    the diffs, so the same tracker gives the same strikes whether the diffs
+    come straight from the decoder or from a stitched or cached series.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        # savestate for using the deadzone.
+        self.deadzone = 0
+        # frames saved into the current clip
+        self.clip_frames = 0
+        # strike counter independent for file.
+        self.strikes = 0
+
+    def update(self, diff1, threshold=None):
+        """Advances the deadzone by one frame.
+
+        threshold replaces the tracker's threshold from this frame on, for
+        thresholds that change from frame to frame (see RollingThreshold).
+
+        Returns (save, new_clip). save is True if the frame should be written
+        as an image and added to the current clip. new_clip is True when
+        this frame starts a new clip. A clip ends at the first frame that
+        isn't saved, or when a new clip starts.
+        """
+        if threshold is not None:
+            self.threshold = threshold
+        new_clip = False
+        if self.clip_frames == GIF_FRAMES_LIMIT:
+            # end a gif if the clip gets large to prevent computer issues.
+            # massive gifs can cause lag and other problems.
+            self.deadzone = 0
+        if diff1 > self.threshold:
+            # pass condition to save a frame and start a save state
+            self.strikes = self.strikes + 1
+            if self.deadzone == 0:
+                # lightning after a quiet spell starts a new clip.
+                new_clip = True
+                self.clip_frames = 0
+            # deadzone must be an int > 0 to save an image.
+            self.deadzone = 3
+        if diff1 < self.threshold*END_STRIKE_PERCENTAGE:
+            # itterates deadzone to zero, leaving deadzone condition.
+            # if the diff is less than the end strike percentage, the
+            # deadzone is reduced by 1. Deadzone of 0 will result
+            # in not saving the frame.
+            if self.deadzone > 0:
+                self.deadzone = self.deadzone - 1
+        save = self.deadzone > 0
+        if save:
+            self.clip_frames = self.clip_frames + 1
+        return save, new_clip
+
+
+def analyze_video(f_in, out_folder, threshold, name_by_frame=True,
+                  progress=None, workers=1, options=None):
+    """Analyzes a single video for lightning.
+
+    Writes the diff index, strike table, strike frames and strike clips to
+    out_folder, plus the per frame csv with options.csv, and returns a dict
+    of statistics about the video, or None if f_in is not a video.
+    progress is an optional callable taking the fraction (0 to 1) of the
+    video processed. With workers > 1 a long video is split into frame
+    ranges that are scanned in parallel, see analyze_video_two_pass,
+    which is also used when options.two_pass is set. With options.reanalyze
+    the saved diff index is reused if it is still valid, see
+    reanalyze_video. options is an Options instance for the remaining
+    settings. The dict's 'stats' are the StageTimer seconds and counters.
+    """
+    if options is None:
+        options = Options()
+    if options.profile:
+        path = os.path.join(out_folder, os.path.basename(f_in)) + '.prof'
+        return profile_call(path, analyze_video, f_in, out_folder, threshold,
+                            name_by_frame, progress, workers,
+                            Options(**dict(options.as_dict(), profile=False)))
+    if options.reanalyze:
+        return reanalyze_video(f_in, out_folder, threshold, name_by_frame,
+                               progress, workers, options)
+    if workers > 1 or options.two_pass:
+        return analyze_video_two_pass(f_in, out_folder, threshold,
+                                      name_by_frame, progress, workers,
+                                      options)
+    print('Processing ' + os.path.basename(f_in))
+    timer = StageTimer()
+    impath, gifpath = output_dirs(out_folder)
+    filename = os.path.basename(f_in)
+    f_out = os.path.join(out_folder, filename)
+    video = open_video(f_in, options)
+    reader = None
+    writer = None
+    try:
+        # gets statistics on current video
+        nframes, width, height, fps = video_info(video)
+        # checks if input is an actual video before opening csv.
+        if fps == 0 or nframes == 1:
+            print('zerofps or image!')
+            return None
+        params = run_params(threshold, name_by_frame, options)
+        mask = input_mask(f_in, width, height, options)
+        base = base_threshold(threshold, width, height, mask, options)
+        tracker = StrikeTracker(base)
+        rolling = rolling_threshold(base, options)
+        events = EventLog(fps, out_folder)
+        # first loop index to analyze, past 0 when resuming from a checkpoint
+        first = 0
+        diffs = []
+        state = None
+        if options.resume:
+            state = load_checkpoint(f_out, f_in, params)
+        if state is not None:
+            print('Resuming from frame %d' % state['next'])
+            first = state['next']
+            tracker.strikes = state['strikes']
+            tracker.clip_frames = state['clip_frames']
+            events.events = state['events']
+            diffs = _resume_series(series_path(f_out), state['diffs'])
+            if options.csv:
+                _resume_csv(f_out + '.csv', state['csv_bytes'])
+            if rolling is not None:
+                # the window is just the last diffs
+                for diff1 in diffs[-rolling.window:]:
+                    rolling.push(diff1)
+        # frames from just before a strike, to lead each clip in with.
+        ring = FrameRing(pre_trigger_count(width, height, options))
+        # decodes ahead on its own thread, into buffers shared with the ring.
+        # A resumed run starts early enough to refill the ring.
+        lead = max(0, first + 1 - max(ring.capacity, 1))
+        reader = FrameReader(video, every_frame(lead),
+                             buffers=options.prefetch, held=ring.capacity + 1)
+        engine = diff_engine(options, mask)
+        for number in range(lead, first + 1):
+            # reads the video out to give a frame
+            number, frame0 = reader.read()
+            if number == first:
+                if state is not None and 'background' in state:
+                    # the average already has frame first in it
+                    engine.background = state['background']
+                else:
+                    engine.push(frame0)
+            reader.release(ring.push(frame0, (f_in, number)))
+        clock = timer.since('open', timer.start)
+        checkpoint = clock + CHECKPOINT_SECONDS
+        clip = None
+        # diffs not written out yet
+        batch = []
+        writer = OutputWriter(options)
+        extension = image_extension(options)
+        gif_extension = clip_extension(options, f_in)
+        # remove filename period, so that the output files don't confuse
+        # anything.
+        filename = filename.replace('.', '_')
+        # the diffs go to the index at the end; until then they are appended to
+        # a binary file to resume from, and to the csv if it is wanted.
+        with open(series_path(f_out), 'ab' if first else 'wb') as series, \
+                open_csv(f_out, options, first) as fff:
+            for i in range(first, nframes-1):
+                # loops through all of the frames, looking for strikes.
+                if progress is not None:
+                    progress(i/(nframes+1))
+                # process the video. Loop time goes to decode (waiting on the
+                # reader), diff, and write_wait for the rest, which is mostly
+                # waiting on the writer when it falls behind.
+                clock = timer.since('write_wait', clock)
+                number, frame1 = reader.read()
+                clock = timer.since('decode', clock)
+                if frame1 is None:
+                    # frame count from the container was too high
+                    break
+                diff1 = engine.push(frame1)
+                clock = timer.since('diff', clock)
+                diffs.append(diff1)
+                # checks for file output name system
+                # names files and gifs respectively.
+                imname, gifname = output_names(impath, gifpath, filename, i,
+                                               fps, name_by_frame, extension,
+                                               gif_extension)
+                level = None
+                if rolling is not None:
+                    level = rolling.level()
+                    rolling.push(diff1)
+                save, new_clip = tracker.update(diff1, level)
+                events.add(i, diff1, save, new_clip, imname, gifname)
+                if clip is not None and (new_clip or not save):
+                    writer.close_clip(clip)
+                    clip = None
+                if new_clip:
+                    clip = writer.open_clip(gifname, (width, height),
+                                            clip_rate(options, fps))
+                    for frame, source in ring.items():
+                        # ring frames go back to the reader before the writer
+                        # is done with them
+                        writer.clip_frame(clip, frame.copy(), source)
+                if save:
+                    # save frame for passing the deadzone condition. The reader
+                    # reuses frame1, so the writer gets its own copy.
+                    saved = frame1.copy()
+                    writer.image(imname, saved)
+                    writer.clip_frame(clip, saved, (f_in, number))
+                # the ring hands back the frame it no longer needs
+                reader.release(ring.push(frame1, (f_in, number)))
+                # write threshold data out, a batch at a time
+                batch.append(diff1)
+                if len(batch) == CSV_BATCH:
+                    clock = timer.since('write_wait', clock)
+                    _write_diffs(series, fff, f_out, batch)
+                    clock = timer.since('csv', clock)
+                    batch = []
+                if not save and clock > checkpoint:
+                    # no strike going, so the loop state is small enough to
+                    # save once everything before it is on disk.
+                    _write_diffs(series, fff, f_out, batch)
+                    batch = []
+                    series.flush()
+                    state = {'next': i + 1, 'strikes': tracker.strikes,
+                             'clip_frames': tracker.clip_frames,
+                             'diffs': len(diffs), 'events': events.events}
+                    if fff is not None:
+                        fff.flush()
+                        state['csv_bytes'] = fff.tell()
+                    writer.flush()
+                    save_checkpoint(f_out, f_in, params, state,
+                                    engine.background)
+                    clock = timer.since('checkpoint', clock)
+                    checkpoint = clock + CHECKPOINT_SECONDS
+            clock = timer.since('write_wait', clock)
+            _write_diffs(series, fff, f_out, batch)
+        clock = timer.since('csv', clock)
+        # a strike running into the end of the file still gets its clip
+        if clip is not None:
+            writer.close_clip(clip)
+        writes = writer.close()
+    except BaseException:
+        # stopped partway, by an error or Ctrl+C
+        if writer is not None:
+            writer.cancel()
+        raise
+    finally:
+        if reader is not None:
+            reader.close()
+        video.release()
+    clock = timer.since('write_wait', clock)
+    save_index(f_out, f_in, diffs, (nframes, width, height, fps),
+               scan_settings(base, options, two_pass=False, mask=mask))
+    save_events(f_out, f_in, events.events, (nframes, width, height, fps),
+                options.strike_table)
+    clear_checkpoint(f_out)
+    timer.since('index', clock)
+    timer.count('frames', len(diffs))
+    timer.count('strikes', tracker.strikes)
+    timer.writes(writes)
+    return _result(f_in, f_out, nframes, tracker.strikes, options, timer,
+                   writes)
+
+
+def _result(f_in, f_out, nframes, strikes, options, timer, writes=None):
+    # The result dict of an analysis, counting the files it wrote.
+    csv = f_out + '.csv' if options.csv else None
+    table = events_path(f_out, options.strike_table)
+    written = [table, f_out + '.npy', f_out + '.json']
+    if csv is not None:
+        written.append(csv)
+    timer.written(*written)
+    result = {'file': f_in, 'frames': nframes, 'strikes': strikes,
+              'events': table, 'diffs': f_out + '.npy', 'csv': csv}
+    if writes is not None:
+        result['writes'] = writes
+    result['stats'] = timer.as_dict()
+    return result
+
+
+@contextlib.contextmanager
+def open_csv(f_out, options, append=False):
+    '''Opens the per frame csv if options.csv asks for it, else gives None.'''
+    if not options.csv:
+        yield None
+        return
+    with open(f_out + '.csv', 'a' if append else 'w') as fff:
+        yield fff
+
+
+def _write_diffs(series, fff, f_out, batch):
+    # Appends diffs to the binary series and the csv, if there is one.
+    np.asarray(batch, np.int64).tofile(series)
+    if fff is not None:
+        fff.writelines(str(f_out)+', '+str(diff1)+'\n' for diff1 in batch)
+
+
+def _export_csv(f_out, diffs):
+    # Writes a whole diff series as the per frame csv.
+    with open(f_out + ".csv", 'w') as fff:
+        prefix = str(f_out)+', '
+        for start in range(0, len(diffs), CSV_BATCH):
+            fff.writelines(prefix + str(diff1) + '\n'
+                           for diff1 in diffs[start:start + CSV_BATCH])
+
+
+def _resume_series(path, count):
+    # Cuts the binary series back to its checkpointed length, returns it.
+    with open(path, 'r+b') as series:
+        series.truncate(count*8)
+    return np.fromfile(path, np.int64).tolist()
+
+
+def _resume_csv(path, size):
+    # Cuts the csv back to its checkpointed size.
+    with open(path, 'r+') as fff:
+        fff.truncate(size)
+
+
+def scan_diffs(f_in, start, stop, threshold, options=None, report=None,
+               timer=None):
+    """Returns the diffs for loop indexes start to stop of a video.
+
+    Diff i compares frame i with frame i+1, so the range reads frames start
+    to stop inclusive; neighbouring ranges overlap by one frame and stitch
+    together into the same series as one sequential pass.
+
+    The scan runs at the scale and stride of scan_plan. A smaller scale
+    than SCALE shrinks frames further, with the counts scaled back up so the
+    threshold means the same; a stride only diffs every k-th frame and
+    grabs past the rest. Whenever such a coarse diff gets within
+    REFINE_LEVEL of the threshold the scan goes back to the full rate and
+    SCALE, rescanning the skipped frames, and stays there until the diff
+    has been quiet for a whole stride. Diffs near the threshold are then
+    exactly those of a sequential pass. Skipped indexes get the strided
+    diff. A StageTimer passed as timer gets the open, decode and diff times.
+    """
+    if options is None:
+        options = Options()
+    if timer is None:
+        timer = StageTimer()
+    clock = time.perf_counter()
+    threshold = int(threshold)
+    refine = threshold*REFINE_LEVEL
+    probe = cv2.VideoCapture(f_in)
+    nframes, width, height, fps = video_info(probe)
+    probe.release()
+    scale, stride = scan_plan(width, height, fps, options)
+    # counts at scale, brought back to pixel counts at SCALE
+    factor = (SCALE/scale)**2
+    # a running average can't skip frames or change size along the way
+    switching = ((stride > 1 or scale != SCALE)
+                 and background_key(options) is None)
+    # decoders that can shrink frames give them at the largest size needed,
+    # and the engines shrink by what is left. One that can change size as
+    # it goes gives the coarse scan its small frames, and SCALE when fine.
+    video = open_video(f_in, options, SCALE if switching else scale,
+                       options.gray_diff)
+    full_decoded = decoded_format(video)[0]
+    rescaling = (switching and scale != SCALE
+                 and hasattr(video, 'rescale'))
+    if rescaling:
+        video.rescale(scale)
+    decoded = decoded_format(video)[0]
+    mask = input_mask(f_in, width, height, options)
+    coarse = diff_engine(options, _decoded_mask(mask, decoded),
+                         scale/decoded)
+    full = coarse
+    if switching and scale != SCALE:
+        full = diff_engine(options, _decoded_mask(mask, full_decoded),
+                           SCALE/full_decoded)
+    # the previous frame is held, to rediff it in full without a seek
+    reader = FrameReader(video, strided(start, stop, stride),
+                         options.prefetch, held=2)
+    try:
+        number, previous = reader.read()
+        coarse.push(previous)
+        clock = timer.since('open', clock)
+        diffs = np.zeros(max(stop - start, 0), np.int64)
+        # i is the next loop index; the engine holds frame i.
+        i = start
+        # quiet diffs left before going back to the coarse scan, 0 when coarse
+        fine = 0
+        while i < stop:
+            if report is not None:
+                report((i - start)/max(stop - start, 1))
+            clock = time.perf_counter()
+            number, frame1 = reader.read()
+            clock = timer.since('decode', clock)
+            if frame1 is None:
+                diffs = diffs[:i - start]
+                break
+            step = number - i
+            if fine:
+                diff1 = full.push(frame1)
+            else:
+                diff1 = coarse.push(frame1)
+                if factor != 1:
+                    diff1 = int(round(diff1*factor))
+            if not fine and switching and diff1 > refine:
+                # something may be happening, look at every frame in full
+                full.reset()
+                fine = stride
+                if step > 1 or rescaling:
+                    # go back for the skipped frames, or for frames big
+                    # enough for the full engine
+                    reader.release(previous)
+                    reader.release(frame1)
+                    if rescaling:
+                        reader.close()
+                        video.rescale(SCALE)
+                    reader.restart(range(i, stop + 1))
+                    number, previous = reader.read()
+                    full.push(previous)
+                    timer.since('diff', clock)
+                    continue
+                full.push(previous)
+                diff1 = full.push(frame1)
+            timer.since('diff', clock)
+            diffs[i - start:i - start + step] = diff1
+            i = i + step
+            reader.release(previous)
+            previous = frame1
+            if fine:
+                fine = stride if diff1 > refine else fine - 1
+                if fine == 0:
+                    # quiet again, back to the coarse scan
+                    coarse.reset()
+                    if rescaling:
+                        # frame i again, small
+                        reader.close()
+                        video.rescale(scale)
+                        reader.release(previous)
+                        reader.restart(strided(i, stop, stride))
+                        number, previous = reader.read()
+                        if previous is not None:
+                            coarse.push(previous)
+                    else:
+                        coarse.push(frame1)
+                        if stride > 1:
+                            reader.restart(strided(i + stride, stop,
+                                                   stride))
+        reader.release(previous)
+    finally:
+        reader.close()
+        video.release()
+    timer.count('frames', len(diffs))
+    return diffs
+
+
+def _decoded_mask(mask, decoded):
+    # the mask at the size the decoder gives frames, scale decoded
+    if mask is None or decoded == 1:
+        return mask
+    height, width = mask.shape
+    return cv2.resize(mask, (round(width*decoded), round(height*decoded)),
+                      interpolation=cv2.INTER_NEAREST)
+
+
+def plan_strikes(diffs, threshold, names, pre_trigger=0, events=None):
+    """Replays the deadzone over a diff series without touching the video.
+
+    names is a callable giving (image name, gif name) for a loop index.
+    Returns the images as {frame number: image name} and the clips as a list
+    of (gif name, [frame numbers]), plus the strike count. Loop index i saves
+    frame number i+1, the newer frame of its diff. Each clip starts with up
+    to pre_trigger frames from before its strike. threshold is a number or
+    an array with one per diff, see frame_thresholds. An EventLog passed as
+    events gets every step of the replay.
+    """
+    diffs = np.asarray(diffs)
+    levels = None
+    if np.ndim(threshold) > 0:
+        levels = np.asarray(threshold)
+        threshold = levels[0] if len(levels) else 0
+    tracker = StrikeTracker(threshold)
+    # outside the deadzone nothing happens until a frame is over the
+    # threshold, so the replay jumps straight between those.
+    above = np.flatnonzero(diffs > (threshold if levels is None else levels))
+    images = {}
+    clips = []
+    i = 0
+    while i < len(diffs):
+        if tracker.deadzone == 0:
+            k = np.searchsorted(above, i)
+            if k == len(above):
+                break
+            i = int(above[k])
+        imname, gifname = names(i)
+        save, new_clip = tracker.update(
+            int(diffs[i]), None if levels is None else float(levels[i]))
+        if events is not None:
+            events.add(i, int(diffs[i]), save, new_clip, imname, gifname)
+        if new_clip:
+            clips.append((gifname, list(range(max(0, i + 1 - pre_trigger),
+                                              i + 1))))
+        if save:
+            images[i + 1] = imname
+            clips[-1][1].append(i + 1)
+        i = i + 1
+    return images, clips, tracker.strikes
+
+
+def extract_frames(f_in, images, clips, size, options=None, fps=CLIP_FPS,
+                   timer=None):
+    """Writes the planned images and clips by seeking to the needed frames.
+
+    Frames are read in order and streamed to every clip they belong to as
+    they arrive, so nothing is buffered. The FrameReader skips gaps longer
+    than SEEK_GAP frames with a seek and shorter ones by grabbing.
+    Clips still open when the video ends are closed with what they have.
+    Clips cut from the video (see Options.clip_mode) don't need any frames
+    read. Returns the OutputWriter stats, which are also added to timer if
+    given, along with the time spent seeking and decoding.
+    """
+    if options is None:
+        options = Options()
+    if timer is None:
+        timer = StageTimer()
+    writer = OutputWriter(options)
+    video = None
+    reader = None
+    try:
+        if options.clip_mode != 'encode':
+            for gif_name, frames in clips:
+                handle = writer.open_clip(gif_name, size, fps)
+                for number in frames:
+                    writer.clip_frame(handle, None, (f_in, number))
+                writer.close_clip(handle)
+            clips = []
+        # frame number -> indexes of the clips it is in. Pre-trigger frames
+        # can be in two clips.
+        members = {}
+        for index, (gif_name, frames) in enumerate(clips):
+            for number in frames:
+                members.setdefault(number, []).append(index)
+        needed = sorted(set(images) | set(members))
+        handles = {}
+        remaining = [len(frames) for gif_name, frames in clips]
+        video = open_video(f_in, options)
+        reader = FrameReader(video, needed, options.prefetch)
+        while True:
+            clock = time.perf_counter()
+            number, frame = reader.read()
+            timer.since('seek', clock)
+            if frame is None:
+                break
+            if number in images or number in members:
+                # the writer keeps the frame, the reader reuses its buffer
+                saved = frame.copy()
+            reader.release(frame)
+            if number in images:
+                writer.image(images[number], saved)
+            for index in members.get(number, ()):
+                if index not in handles:
+                    handles[index] = writer.open_clip(clips[index][0], size,
+                                                      fps)
+                writer.clip_frame(handles[index], saved)
+                remaining[index] = remaining[index] - 1
+                if remaining[index] == 0:
+                    writer.close_clip(handles.pop(index))
+        for handle in handles.values():
+            writer.close_clip(handle)
+        clock = time.perf_counter()
+        writes = writer.close()
+    except BaseException:
+        # stopped partway, by an error or Ctrl+C
+        writer.cancel()
+        raise
+    finally:
+        if reader is not None:
+            reader.close()
+        if video is not None:
+            video.release()
+    timer.since('write_wait', clock)
+    timer.writes(writes)
+    return writes
+
+
+def analyze_video_two_pass(f_in, out_folder, threshold, name_by_frame=True,
+                           progress=None, workers=1, options=None):
+    """Analyzes a video in two passes: scan the diffs, then extract.
+
+    The first pass only computes the diff series (see scan_diffs for the
+    cheaper scan settings) and saves it as the diff index.
+    Replaying it through the same StrikeTracker as a sequential pass gives
+    the strike frames, which the second pass seeks straight to. With
+    default options the output matches analyze_video.
+
+    With workers > 1 the video is split into one frame range per worker and
+    the ranges are scanned in parallel on a process pool.
+    """
+    if options is None:
+        options = Options()
+    print('Processing ' + os.path.basename(f_in))
+    timer = StageTimer()
+    impath, gifpath = output_dirs(out_folder)
+    filename = os.path.basename(f_in)
+    f_out = os.path.join(out_folder, filename)
+    video = cv2.VideoCapture(f_in)
+    nframes, width, height, fps = video_info(video)
+    video.release()
+    if fps == 0 or nframes == 1:
+        print('zerofps or image!')
+        return None
+    if progress is None:
+        progress = _no_progress
+    mask = input_mask(f_in, width, height, options)
+    base = base_threshold(threshold, width, height, mask, options)
+    # split the loop indexes 0 to nframes-1 into even ranges. A running
+    # average background depends on every frame before, so it can't split.
+    chunks = max(1, min(workers, (nframes - 1)//CHUNK_MIN_FRAMES))
+    if background_key(options) is not None:
+        chunks = 1
+    bounds = [(nframes - 1)*k//chunks for k in range(chunks + 1)]
+    jobs = [(f_in, bounds[k], bounds[k + 1], base, options)
+            for k in range(chunks)]
+    # scanning is most of the work, extraction the rest.
+    if chunks == 1:
+        series = [scan_diffs(*jobs[0],
+                             report=lambda done: progress(0.9*done),
+                             timer=timer)]
+    else:
+        # the chunk processes keep their own time, only the total is seen
+        clock = time.perf_counter()
+        series = _pool_map(scan_diffs, jobs, workers,
+                           lambda done: progress(0.9*done/len(jobs)))
+        timer.since('scan', clock)
+    diffs = np.concatenate(series)
+    if chunks > 1:
+        timer.count('frames', len(diffs))
+    clock = time.perf_counter()
+    save_index(f_out, f_in, diffs, (nframes, width, height, fps),
+               scan_settings(base, options, mask=mask,
+                             plan=scan_plan(width, height, fps, options)))
+    clock = timer.since('index', clock)
+    filename = filename.replace('.', '_')
+    events = EventLog(fps, out_folder)
+    images, clips, strikes = plan_strikes(
+        diffs, frame_thresholds(diffs, base, options),
+        lambda i: output_names(impath, gifpath, filename, i, fps,
+                               name_by_frame, image_extension(options),
+                               clip_extension(options, f_in)),
+        pre_trigger_count(width, height, options), events)
+    save_events(f_out, f_in, events.events, (nframes, width, height, fps),
+                options.strike_table)
+    clock = timer.since('plan', clock)
+    if options.csv:
+        _export_csv(f_out, diffs)
+        timer.since('csv', clock)
+    writes = extract_frames(f_in, images, clips, (width, height), options,
+                            clip_rate(options, fps), timer)
+    progress(1.0)
+    timer.count('strikes', strikes)
+    return _result(f_in, f_out, nframes, strikes, options, timer, writes)
+
+
+def reanalyze_video(f_in, out_folder, threshold, name_by_frame=True,
+                    progress=None, workers=1, options=None):
+    """Re-runs the strike detection of a video from its diff index.
+
+    Only the strike frames are read back from the video. Falls back to a
+    two pass analysis, which writes the index, when there is no usable
+    index for f_in. The strike table is rewritten; a csv is left as it is,
+    since the diffs are unchanged, and only written if options.csv asks for
+    one that isn't there.
+    """
+    if options is None:
+        options = Options()
+    timer = StageTimer()
+    filename = os.path.basename(f_in)
+    f_out = os.path.join(out_folder, filename)
+    video = cv2.VideoCapture(f_in)
+    nframes, width, height, fps = video_info(video)
+    video.release()
+    base = threshold
+    if fps > 0:
+        mask = input_mask(f_in, width, height, options)
+        base = base_threshold(threshold, width, height, mask, options)
+    index = load_index(f_out, f_in, base, options)
+    if index is None:
+        return analyze_video_two_pass(f_in, out_folder, threshold,
+                                      name_by_frame, progress, workers,
+                                      options)
+    print('Reanalyzing ' + filename)
+    diffs, meta = index
+    clock = timer.since('index', timer.start)
+    impath, gifpath = output_dirs(out_folder)
+    filename = filename.replace('.', '_')
+    events = EventLog(meta['fps'], out_folder)
+    images, clips, strikes = plan_strikes(
+        diffs, frame_thresholds(diffs, base, options),
+        lambda i: output_names(impath, gifpath, filename, i, meta['fps'],
+                               name_by_frame, image_extension(options),
+                               clip_extension(options, f_in)),
+        pre_trigger_count(meta['width'], meta['height'], options), events)
+    save_events(f_out, f_in, events.events,
+                (meta['frames'], meta['width'], meta['height'], meta['fps']),
+                options.strike_table)
+    clock = timer.since('plan', clock)
+    if options.csv and not os.path.exists(f_out + '.csv'):
+        _export_csv(f_out, diffs)
+        timer.since('csv', clock)
+    writes = extract_frames(f_in, images, clips,
+                            (meta['width'], meta['height']), options,
+                            clip_rate(options, meta['fps']), timer)
+    if progress is not None:
+        progress(1.0)
+    timer.count('strikes', strikes)
+    return _result(f_in, f_out, meta['frames'], strikes, options, timer,
+                   writes)
+
+
+def sweep_thresholds(f_in, out_folder, thresholds, options=None):
+    """Counts what each threshold would detect, without writing any frames.
+
+    Uses the diff index in out_folder, scanning the video once to make it if
+    needed. The thresholds are pixel counts, used as the floor of the
+    rolling threshold when options.threshold_k is set. Returns a dict per
+    threshold with the strike, image and clip counts, or None if f_in is
+    not a video.
+    """
+    if options is None:
+        options = Options()
+    filename = os.path.basename(f_in)
+    f_out = os.path.join(out_folder, filename)
+    # a coarse index is good for thresholds above the one it was made for
+    lowest = min(int(threshold) for threshold in thresholds)
+    index = load_index(f_out, f_in, lowest, options)
+    if index is None:
+        video = cv2.VideoCapture(f_in)
+        info = video_info(video)
+        video.release()
+        nframes, width, height, fps = info
+        if fps == 0 or nframes == 1:
+            return None
+        diffs = scan_diffs(f_in, 0, nframes - 1, lowest, options)
+        mask = input_mask(f_in, width, height, options)
+        save_index(f_out, f_in, diffs, info,
+                   scan_settings(lowest, options, mask=mask,
+                                 plan=scan_plan(width, height, fps, options)))
+    else:
+        diffs = index[0]
+    results = []
+    for threshold in thresholds:
+        images, clips, strikes = plan_strikes(
+            diffs, frame_thresholds(diffs, int(threshold), options),
+            lambda i: (None, None))
+        results.append({'threshold': int(threshold), 'strikes': strikes,
+                        'images': len(images), 'clips': len(clips)})
+    return results
+
+
+def check_settings(in_folder, out_folder, options):
+    '''Raises AnalysisError if the folders, masks, decoder, strike table
+    format or clip settings can't be used.'''
+    if not os.path.isdir(in_folder):
+        raise AnalysisError('Input folder not valid. Select a valid folder.')
+    if not os.path.isdir(out_folder):
+        raise AnalysisError('Output folder not valid. Select a valid folder.')
+    if options.mask is not None and not os.path.isfile(options.mask):
+        raise AnalysisError('Mask image not found. Select a valid image.')
+    # the masks are read now, rather than failing partway through the videos
+    masks = [f_in for f_in in folder_inputs(in_folder)
+             if f_in.endswith(MASK_SUFFIX)]
+    if options.mask is not None:
+        masks.insert(0, options.mask)
+    for path in masks:
+        try:
+            read_mask(path)
+        except ValueError:
+            raise AnalysisError('Could not read the mask image %s. Select a '
+                                'valid image.' % path)
+    if masks or options.exclude:
+        # and they have to leave some of every video to analyze
+        for f_in in folder_inputs(in_folder):
+            if f_in.endswith(MASK_SUFFIX):
+                continue
+            video = cv2.VideoCapture(f_in)
+            nframes, width, height, fps = video_info(video)
+            video.release()
+            if fps == 0:
+                continue
+            mask = input_mask(f_in, width, height, options)
+            if mask is not None and not mask.any():
+                raise AnalysisError('The mask leaves nothing of %s to '
+                                    'analyze. Select a mask with some white '
+                                    'in it, or exclude less.' % f_in)
+    if not decoder_available(options.decoder):
+        raise AnalysisError('The %s decoder is not available here. Choose '
+                            'one of: %s.' % (options.decoder, ', '.join(
+                                name for name in DECODERS
+                                if decoder_available(name))))
+    if options.decode_threads and not decode_threads_available(
+            options.decoder):
+        raise AnalysisError('OpenCV %s cannot set its decode threads, that '
+                            'needs 4.6 or newer. Update it, use another '
+                            'decoder, or leave decode threads at 0.'
+                            % cv2.__version__)
+    if not table_available(options.strike_table):
+        raise AnalysisError('Parquet strike tables need the pyarrow package. '
+                            'Install it or use json.')
+    if options.clip_encoder not in CLIP_ENCODERS:
+        raise AnalysisError('Unknown clip encoder: ' + str(options.clip_encoder))
+    if options.clip_mode == 'encode' and options.clip_encoder == 'opencv':
+        if options.clip_format != 'mp4':
+            raise AnalysisError('The opencv clip encoder only writes mp4. '
+                                'Use the ffmpeg encoder for %s clips.'
+                                % options.clip_format)
+    elif ffmpeg_path() is None:
+        raise AnalysisError('Copying clips and the ffmpeg clip encoder need '
+                            'ffmpeg on the PATH.')
+
+
+def folder_inputs(in_folder):
+    '''Returns the paths of the files (not folders) in in_folder.'''
+    f_ins = [os.path.join(in_folder, filename)
+             for filename in os.listdir(in_folder)]
+    return [f_in for f_in in f_ins if not os.path.isdir(f_in)]
+
+
+def analyze_folder(in_folder, out_folder, threshold, name_by_frame=True,
+                   progress=None, workers=1, options=None):
+    """Analyzes every video in in_folder.
+
+    progress is an optional callable taking the percentage (10 to 100) of
+    the whole folder processed, matching the GUI progress bar. workers sets
+    how many videos are analyzed at once in separate processes; 0 uses one
+    per cpu. options is an Options instance for the remaining settings.
+    Returns a list of the per video result dicts in folder order, which are
+    also saved with the settings and totals as a json run report,
+    REPORT_NAME in out_folder.
+
+    Finished videos are recorded in the run manifest in out_folder. With
+    options.resume, videos it lists as finished with the same settings are
+    skipped and their saved result is returned with 'skipped' set.
+    """
+    if progress is None:
+        progress = _no_progress
+    if options is None:
+        options = Options()
+    started = time.time()
+    start = time.perf_counter()
+    # set progress bar to 10 so people know it is working
+    progress(10)
+    check_settings(in_folder, out_folder, options)
+    # create frame and gif directories after checking for existence
+    output_dirs(out_folder)
+    # get the current directory files count. If the outfolder is the same
+    # as the infolder, this might have changed after creating the output
+    # folders above.
+    f_ins = folder_inputs(in_folder)
+    manifest = Manifest(out_folder, run_params(threshold, name_by_frame,
+                                               options))
+    skipped = {}
+    if options.resume:
+        skipped = {f_in: manifest.result(f_in) for f_in in f_ins
+                   if manifest.finished(f_in)}
+    todo = [f_in for f_in in f_ins if f_in not in skipped]
+    for f_in in todo:
+        manifest.start(f_in)
+    manifest.save()
+
+    def finished(index, result):
+        manifest.done(todo[index], result)
+        manifest.save()
+
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(todo) >= workers:
+        results = _analyze_parallel(todo, out_folder, threshold,
+                                    name_by_frame, progress, workers, options,
+                                    finished)
+    else:
+        # fewer videos than workers, so split each video across the pool.
+        results = _analyze_serial(todo, out_folder, threshold,
+                                  name_by_frame, progress, workers, options,
+                                  finished)
+    results = dict(zip(todo, results))
+    results.update(skipped)
+    results = [results[f_in] for f_in in f_ins if results[f_in] is not None]
+    save_report(os.path.join(out_folder, REPORT_NAME), {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                 time.localtime(started)),
+        'seconds': round(time.perf_counter() - start, 4),
+        'input_folder': in_folder, 'output_folder': out_folder,
+        'threshold': int(threshold), 'workers': workers,
+        'options': options.as_dict(),
+        'totals': totals(results), 'videos': results})
+    progress(100)
+    print('analysis complete!')
+    return results
+
+
+def _analyze_serial(f_ins, out_folder, threshold, name_by_frame, progress,
+                    workers=1, options=None, finished=None):
+    # set per file progress bar quantity
+    per_file = 90/max(len(f_ins), 1)
+    results = []
+    for index, f_in in enumerate(f_ins):
+        # itterates over files in directory
+        file_base = 10 + index*per_file
+        progress(file_base)
+        results.append(analyze_video(
+            f_in, out_folder, threshold, name_by_frame,
+            progress=lambda fraction: progress(file_base + fraction*per_file),
+            workers=workers, options=options))
+        if finished is not None:
+            finished(index, results[-1])
+    return results
+
+
+def _analyze_parallel(f_ins, out_folder, threshold, name_by_frame, progress,
+                      workers, options=None, finished=None):
+    # Each video is analyzed in its own process and writes its own index,
+    # frames and clips, so the output matches a serial run.
+    per_file = 90/len(f_ins)
+    jobs = [(f_in, out_folder, threshold, name_by_frame, options)
+            for f_in in f_ins]
+    return _pool_map(_pool_analyze_video, jobs, workers,
+                     lambda done: progress(10 + done*per_file), finished)
+
+
+def _pool_analyze_video(f_in, out_folder, threshold, name_by_frame, options,
+                        report):
+    return analyze_video(f_in, out_folder, threshold, name_by_frame,
+                         progress=report, options=options)
+
+
+def _pool_map(function, jobs, workers, progress, finished=None):
+    # Runs function(*job, report) for every job on a process pool and
+    # returns the results in job order. report takes the fraction of the job
+    # done; it comes back over a queue and progress gets the summed fraction
+    # of all jobs (0 to len(jobs)). finished(index, result) is called as
+    # each job succeeds.
+    fractions = [0.0]*len(jobs)
+    with multiprocessing.Manager() as manager:
+        queue = manager.Queue()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for index, job in enumerate(jobs):
+                future = pool.submit(_pool_call, function, job, queue, index)
+                futures[future] = index
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.2)
+                while not queue.empty():
+                    index, fraction = queue.get()
+                    fractions[index] = fraction
+                for future in done:
+                    fractions[futures[future]] = 1.0
+                    if finished is not None and future.exception() is None:
+                        finished(futures[future], future.result())
+                progress(sum(fractions))
+            results = [None]*len(jobs)
+            for future, index in futures.items():
+                # re-raises anything that went wrong in the worker
+                results[index] = future.result()
+    return results
+
+
+def _pool_call(function, job, queue, index):
+    # Runs in a pool process. Only whole percent steps are sent back, so the
+    # queue doesn't see a message per frame.
+    last = [-1]
+
+    def report(fraction):
+        percent = int(fraction*100)
+        if percent != last[0]:
+            last[0] = percent
+            queue.put((index, fraction))
+
+    return function(*job, report)
+
+
+def _no_progress(value):
+    pass
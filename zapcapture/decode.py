@@ -0,0 +1,316 @@
+"""Video decoding backends.
+
+open_video opens a video with the decoder named by Options.decoder. Every
+decoder gives an object that works like cv2.VideoCapture as far as
+ZapCapture uses it: get() for the frame count, size, fps and position,
+grab(), read(image=buffer), set(cv2.CAP_PROP_POS_FRAMES, number) and
+release(). FrameReader and video_info take any of them.
+
+'opencv' is cv2.VideoCapture, with the decoder's thread count and
+hardware acceleration settable. 'ffmpeg' runs an ffmpeg process and reads
+its raw frames from a pipe straight into the reused frame buffers. 'pyav'
+decodes with the optional av package, on the codec's own threads. The
+ffmpeg and pyav decoders can also shrink and gray the frames as they
+decode them, which saves the two pass scan a resize and most of the
+copying; their capture's scale and gray attributes say what they give.
+The ffmpeg capture's rescale() changes the scale partway through.
+"""
+
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+DECODERS = ('opencv', 'ffmpeg', 'pyav')
+# what get() answers from the probe, the rest are 0
+_INFO = (cv2.CAP_PROP_FRAME_COUNT, cv2.CAP_PROP_FRAME_WIDTH,
+         cv2.CAP_PROP_FRAME_HEIGHT, cv2.CAP_PROP_FPS)
+
+
+def ffmpeg_path():
+    return shutil.which('ffmpeg')
+
+
+def decoder_available(name):
+    '''True if the decoder name can be used here.'''
+    if name == 'ffmpeg':
+        return ffmpeg_path() is not None
+    if name == 'pyav':
+        return av is not None
+    return name == 'opencv'
+
+
+def decode_threads_available(name):
+    '''True if the decoder name can set its own thread count here.'''
+    # CAP_PROP_N_THREADS is new in opencv 4.6
+    return name != 'opencv' or hasattr(cv2, 'CAP_PROP_N_THREADS')
+
+
+def open_video(f_in, options, scale=1.0, gray=False):
+    """Opens f_in with options.decoder.
+
+    scale and gray ask for frames shrunk by scale (like cv2.resize with
+    fx=fy=scale) and in grayscale. Only the ffmpeg and pyav decoders do
+    that; see decoded_format for what the returned capture gives.
+    """
+    if options.decoder == 'ffmpeg':
+        return FFmpegCapture(f_in, scale, gray, options.decode_threads,
+                             options.hw_decode)
+    if options.decoder == 'pyav':
+        return PyAVCapture(f_in, scale, gray, options.decode_threads)
+    return opencv_capture(f_in, options)
+
+
+def decoded_format(video):
+    '''(scale, gray) of the frames an open_video capture reads.'''
+    return getattr(video, 'scale', 1.0), getattr(video, 'gray', False)
+
+
+def opencv_capture(f_in, options):
+    '''cv2.VideoCapture with the decode_threads and hw_decode options.'''
+    params = []
+    if options.decode_threads and decode_threads_available('opencv'):
+        params += [cv2.CAP_PROP_N_THREADS, int(options.decode_threads)]
+    if options.hw_decode:
+        params += [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+    if not params:
+        return cv2.VideoCapture(f_in)
+    return cv2.VideoCapture(f_in, cv2.CAP_ANY, params)
+
+
+def _probe(f_in):
+    # frame count, size and fps as opencv sees them, so every decoder
+    # agrees with video_info on a cv2.VideoCapture
+    video = cv2.VideoCapture(f_in)
+    info = {prop: video.get(prop) for prop in _INFO}
+    video.release()
+    return info
+
+
+class _ScaledCapture:
+    # What the ffmpeg and pyav captures share: the probe, the output frame
+    # shape and the cv2.VideoCapture style get().
+
+    def __init__(self, f_in, scale, gray):
+        self.f_in = f_in
+        self.info = _probe(f_in)
+        self.gray = gray
+        self.fps = self.info[cv2.CAP_PROP_FPS]
+        self._set_scale(scale)
+        self.position = 0
+
+    def _set_scale(self, scale):
+        self.scale = scale
+        width = int(self.info[cv2.CAP_PROP_FRAME_WIDTH])
+        height = int(self.info[cv2.CAP_PROP_FRAME_HEIGHT])
+        # the size cv2.resize gives for the same scale
+        self.size = (max(1, round(width*scale)), max(1, round(height*scale)))
+        self.shape = (self.size[1], self.size[0])
+        if not self.gray:
+            self.shape = self.shape + (3,)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.position
+        return self.info.get(prop, 0)
+
+    def _buffer(self, image):
+        if image is None or image.shape != self.shape:
+            return np.empty(self.shape, np.uint8)
+        return image
+
+
+class FFmpegCapture(_ScaledCapture):
+    """Decodes with an ffmpeg process, reading raw frames from its stdout.
+
+    Seeking starts a new process at the frame's time, and so does
+    rescale(). threads is ffmpeg's -threads, 0 for its default, and hw asks
+    for -hwaccel auto.
+    """
+
+    def __init__(self, f_in, scale=1.0, gray=False, threads=0, hw=False):
+        if ffmpeg_path() is None:
+            raise ValueError('The ffmpeg decoder needs ffmpeg on the PATH')
+        super().__init__(f_in, scale, gray)
+        self.threads = threads
+        self.hw = hw
+        self.process = None
+        self.scratch = None
+        # set by rescale, the process restarts at the next frame read
+        self.resume = False
+        if self.fps > 0:
+            self._start(0)
+
+    def _start(self, number):
+        self._stop()
+        command = [ffmpeg_path(), '-nostdin', '-loglevel', 'error']
+        if self.hw:
+            command += ['-hwaccel', 'auto']
+        if self.threads:
+            command += ['-threads', str(int(self.threads))]
+        if number:
+            # before -i, so ffmpeg seeks to the keyframe and decodes on
+            command += ['-ss', '%.6f' % (number/self.fps)]
+        command += ['-i', self.f_in, '-map', '0:v:0', '-vsync', '0']
+        if self.scale != 1:
+            command += ['-vf', 'scale=%d:%d:flags=area' % self.size]
+        command += ['-pix_fmt', 'gray' if self.gray else 'bgr24',
+                    '-f', 'rawvideo', '-']
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.position = number
+        self.resume = False
+
+    def _stop(self):
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.process = None
+
+    def _fill(self, buffer):
+        # reads one frame into buffer, False at the end
+        if self.resume:
+            self._start(self.position)
+        if self.process is None:
+            return False
+        view = memoryview(buffer).cast('B')
+        got = 0
+        while got < len(view):
+            count = self.process.stdout.readinto(view[got:])
+            if not count:
+                return False
+            got = got + count
+        self.position = self.position + 1
+        return True
+
+    def isOpened(self):
+        return self.process is not None or self.resume
+
+    def grab(self):
+        self.scratch = self._buffer(self.scratch)
+        return self._fill(self.scratch)
+
+    def read(self, image=None):
+        image = self._buffer(image)
+        if not self._fill(image):
+            return False, None
+        return True, image
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self._start(int(value))
+        return True
+
+    def rescale(self, scale):
+        """Reads the frames from here on shrunk by scale instead.
+
+        ffmpeg does the shrinking, so a scan that only needs small frames
+        doesn't pipe big ones. The new process starts with the next frame
+        read, seeking to it like set().
+        """
+        if scale == self.scale:
+            return
+        self._set_scale(scale)
+        if self.process is not None:
+            self._stop()
+            self.resume = True
+
+    def release(self):
+        self._stop()
+        self.resume = False
+
+
+class PyAVCapture(_ScaledCapture):
+    """Decodes with PyAV, letting the codec decode on its own threads.
+
+    grab() skips the conversion out of the codec's pixel format entirely.
+    threads is the codec thread count, 0 for its default.
+    """
+
+    def __init__(self, f_in, scale=1.0, gray=False, threads=0):
+        if av is None:
+            raise ValueError('The pyav decoder needs the av package')
+        super().__init__(f_in, scale, gray)
+        self.container = None
+        self.frames = None
+        # a frame decoded ahead by a seek
+        self.pending = None
+        if self.fps == 0:
+            # not a video, video_info says so
+            return
+        self.container = av.open(f_in)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+        if threads:
+            self.stream.codec_context.thread_count = int(threads)
+        self.frames = self.container.decode(self.stream)
+
+    def _next(self):
+        if self.pending is not None:
+            frame, self.pending = self.pending, None
+            return frame
+        if self.frames is None:
+            return None
+        frame = next(self.frames, None)
+        if frame is None:
+            self.frames = None
+        return frame
+
+    def isOpened(self):
+        return self.frames is not None
+
+    def grab(self):
+        if self._next() is None:
+            return False
+        self.position = self.position + 1
+        return True
+
+    def read(self, image=None):
+        frame = self._next()
+        if frame is None:
+            return False, None
+        self.position = self.position + 1
+        array = frame.to_ndarray(width=self.size[0], height=self.size[1],
+                                 format='gray' if self.gray else 'bgr24',
+                                 interpolation='AREA')
+        image = self._buffer(image)
+        np.copyto(image, array)
+        return True, image
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES or self.container is None:
+            return False
+        number = int(value)
+        start = self.stream.start_time or 0
+        time_base = self.stream.time_base
+        # to the keyframe before, then decode up to the frame
+        self.container.seek(start + int(number/self.fps/time_base),
+                            stream=self.stream)
+        self.frames = self.container.decode(self.stream)
+        self.pending = None
+        while True:
+            frame = self._next()
+            if frame is None:
+                break
+            if frame.pts is None or round(
+                    float((frame.pts - start)*time_base)*self.fps) >= number:
+                self.pending = frame
+                break
+        self.position = number
+        return True
+
+    def release(self):
+        self.frames = None
+        self.pending = None
+        if self.container is not None:
+            self.container.close()
+            self.container = None
@@ -0,0 +1,201 @@
+"""Frame differencing.
+
+count_diff is the original per pair function. DiffEngine gives the same
+counts while resizing every frame only once, reusing its buffers between
+frames, and can optionally diff in grayscale or over a stacked batch, count
+only inside a region of interest mask, or diff against a running average
+background instead of the previous frame.
+"""
+
+import cv2
+import numpy as np
+
+SCALE = 0.5
+NOISE_CUTOFF = 5
+
+
+def count_diff(img1, img2):
+    # Finds a difference between a frame and the frame before it.
+    small1 = cv2.resize(img1, (0, 0), fx=SCALE, fy=SCALE)
+    small2 = cv2.resize(img2, (0, 0), fx=SCALE, fy=SCALE)
+    diff = cv2.absdiff(small1, small2)
+    diff = cv2.cvtColor(diff, cv2.COLOR_RGB2GRAY)
+    frame_delta1 = cv2.threshold(diff, NOISE_CUTOFF, 255, 3)[1]
+    delta_count1 = cv2.countNonZero(frame_delta1)
+
+    return delta_count1
+
+
+class DiffEngine:
+    """Counts changed pixels between consecutive frames.
+
+    push() each frame in order; it returns the count against the previous
+    frame (None for the first). The downscaled previous frame is kept, so
+    each frame is resized once instead of twice, and all intermediate images
+    live in buffers allocated on the first frame.
+
+    With gray=False the counts are identical to count_diff. gray=True
+    converts the small frames to grayscale before differencing, which is
+    cheaper but gives slightly different counts, since the gray of a
+    difference is not the difference of the grays.
+
+    mask is a full frame uint8 array, nonzero where pixels count (see
+    zapcapture.mask). Frames are cropped to the bounding box of the mask
+    before they are downscaled, so the area outside it is never processed,
+    and pixels inside the box but outside the mask aren't counted.
+
+    With average set, each frame is compared with a running average of the
+    frames before it instead of the previous frame: the background moves
+    average of the way towards every new frame, updated in place. Slow
+    changes like clouds and dusk fade into the background while a flash
+    still stands out against it. Pixels counted as changed are left out of
+    the update, so a flash doesn't linger in the background after it ends.
+    """
+
+    def __init__(self, scale=SCALE, noise_cutoff=NOISE_CUTOFF, gray=False,
+                 mask=None, average=None):
+        self.scale = scale
+        self.noise_cutoff = noise_cutoff
+        self.gray = gray
+        self.average = average
+        self.region = None
+        self.roi = None
+        if mask is not None:
+            self._set_mask(mask)
+        self.reset()
+
+    def _set_mask(self, mask):
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if not len(rows):
+            raise ValueError('The mask excludes the whole frame')
+        # crop on multiples of the downscale step, so the cropped frame
+        # shrinks to exactly the same pixels as the whole frame would.
+        step = max(1, int(round(1/self.scale)))
+        height, width = mask.shape
+        top = rows[0]//step*step
+        bottom = min(height, -(-(rows[-1] + 1)//step)*step)
+        left = cols[0]//step*step
+        right = min(width, -(-(cols[-1] + 1)//step)*step)
+        self.region = (slice(top, bottom), slice(left, right))
+        roi = mask[self.region]
+        # a rectangular mask needs nothing past the crop
+        self.roi = None if roi.all() else roi
+
+    def reset(self):
+        '''Forgets the previous frame, eg. when starting a new video.'''
+        self.previous = None
+        self.current = None
+        self.delta = None
+        self.delta_gray = None
+        self.mask = None
+        self.stack = None
+        # roi at the downscaled size, made with the first count
+        self.roi_small = None
+        self.background = None
+        self.reference = None
+        # pixels the average is updated at, the ones not counted as changed
+        self.still = None
+
+    def shrink(self, frame, out=None):
+        '''Downscales (and grays) a frame, into out if given.
+
+        A 2D frame, grayed by the decoder already, is only downscaled.
+        '''
+        # dsize is left to opencv so the interpolation matches count_diff;
+        # a matching out buffer is reused rather than reallocated.
+        if self.region is not None:
+            frame = frame[self.region]
+        if self.gray and frame.ndim == 3:
+            small = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale)
+            return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=out)
+        return cv2.resize(frame, (0, 0), dst=out, fx=self.scale,
+                          fy=self.scale)
+
+    def count(self, small1, small2):
+        '''Counts the changed pixels between two shrunk frames.'''
+        self.delta = cv2.absdiff(small1, small2, dst=self.delta)
+        delta = self.delta
+        if not self.gray:
+            self.delta_gray = cv2.cvtColor(delta, cv2.COLOR_RGB2GRAY,
+                                           dst=self.delta_gray)
+            delta = self.delta_gray
+        # pixels at or below the noise cutoff don't count
+        self.mask = cv2.compare(delta, self.noise_cutoff, cv2.CMP_GT,
+                                dst=self.mask)
+        if self.roi is not None:
+            cv2.bitwise_and(self.mask, self._roi_small(self.mask.shape),
+                            dst=self.mask)
+        return cv2.countNonZero(self.mask)
+
+    def _roi_small(self, shape):
+        if self.roi_small is None:
+            roi = cv2.resize(self.roi, (shape[1], shape[0]),
+                             interpolation=cv2.INTER_NEAREST)
+            self.roi_small = np.where(roi > 0, 255, 0).astype(np.uint8)
+        return self.roi_small
+
+    def push(self, frame):
+        '''Adds the next frame, returns its diff to the previous one.'''
+        self.current = self.shrink(frame, self.current)
+        if self.average is not None:
+            return self._push_average()
+        if self.previous is None:
+            diff1 = None
+        else:
+            diff1 = self.count(self.previous, self.current)
+        # swap buffers so the next resize overwrites the older frame
+        self.previous, self.current = self.current, self.previous
+        return diff1
+
+    def _push_average(self):
+        if self.background is None:
+            self.background = self.current.astype(np.float32)
+            return None
+        self.reference = cv2.convertScaleAbs(self.background,
+                                             dst=self.reference)
+        diff1 = self.count(self.reference, self.current)
+        self.still = cv2.bitwise_not(self.mask, dst=self.still)
+        cv2.accumulateWeighted(self.current, self.background, self.average,
+                               mask=self.still)
+        return diff1
+
+    def push_batch(self, frames):
+        """Adds a stacked batch of frames (N, height, width, 3).
+
+        Returns an int array of the N diffs, each against the frame before
+        it; the first against the last pushed frame, or -1 if there is none.
+        Not available with a running average background.
+        """
+        if self.average is not None:
+            raise ValueError('push_batch needs the previous frame diff')
+        count = len(frames)
+        first = self.shrink(frames[0])
+        shape = (count + 1,) + first.shape
+        if self.stack is None or self.stack.shape != shape:
+            self.stack = np.empty(shape, np.uint8)
+        # slot 0 holds the previous frame, the batch is shrunk in place
+        # into the rest.
+        self.stack[1] = first
+        for k in range(1, count):
+            self.shrink(frames[k], self.stack[k + 1])
+        if self.previous is not None:
+            self.stack[0] = self.previous
+        # lay the frames out as one tall image so opencv does single passes
+        height = first.shape[0]
+        tall = self.stack.reshape(((count + 1)*height,) + first.shape[1:])
+        delta = cv2.absdiff(tall[height:], tall[:-height])
+        if not self.gray:
+            delta = cv2.cvtColor(delta, cv2.COLOR_RGB2GRAY)
+        mask = cv2.compare(delta, self.noise_cutoff, cv2.CMP_GT)
+        if self.roi is not None:
+            mask = mask.reshape((count, height, -1))
+            mask &= self._roi_small(mask.shape[1:])
+            mask = mask.reshape((count*height, -1))
+        diffs = np.array([cv2.countNonZero(mask[k*height:(k + 1)*height])
+                          for k in range(count)], np.int64)
+        if self.previous is None:
+            diffs[0] = -1
+        self.previous = self.stack[-1].copy()
+        self.current = None
+        return diffs
@@ -0,0 +1,122 @@
+"""Strike event tables.
+
+Every analysis writes <video>.strikes.json next to the diff index: one
+event per clip with the frames it saved, their times, the peak diff and
+the image and clip paths, relative to the output folder, and whether it
+continues a strike from the previous segment of a watched camera.
+Together with the diffs in <video>.npy that holds everything the per
+frame csv did, in a form that loads in milliseconds. With Options.strike_table = 'parquet'
+the table is written as <video>.strikes.parquet instead, which needs the
+optional pyarrow package. load_strikes reads back every table in an
+output folder.
+"""
+
+import glob
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EVENTS_VERSION = 1
+TABLE_FORMATS = ('json', 'parquet')
+# columns of a parquet table, in order
+_COLUMNS = ('video', 'start', 'end', 'start_seconds', 'end_seconds',
+            'peak_diff', 'images', 'clip', 'continued')
+
+
+def events_path(f_out, table='json'):
+    return f_out + '.strikes.' + table
+
+
+def table_available(table):
+    '''True if strike tables of format table can be written here.'''
+    if table == 'parquet':
+        return pyarrow is not None
+    return table == 'json'
+
+
+class EventLog:
+    """Collects the strike events of a video while the deadzone runs.
+
+    add() every loop index the StrikeTracker looked at, with what it
+    returned. An event opens with its clip and closes at the first frame
+    that isn't saved. start and end are the video's own frame numbers:
+    loop index i saves frame i+1, under the file name of index i.
+    """
+
+    def __init__(self, fps, out_folder):
+        self.fps = fps
+        self.out_folder = out_folder
+        self.events = []
+        self.open = False
+
+    def _path(self, name):
+        return os.path.relpath(name, self.out_folder)
+
+    def carry(self, gifname):
+        '''Opens an event for a clip carried over from another segment.'''
+        self.events.append({'start': None, 'end': None,
+                            'start_seconds': None, 'end_seconds': None,
+                            'peak_diff': 0, 'images': [],
+                            'clip': self._path(gifname), 'continued': True})
+        self.open = True
+
+    def add(self, i, diff1, save, new_clip, imname, gifname):
+        if new_clip:
+            self.carry(gifname)
+            self.events[-1]['continued'] = False
+        if not save:
+            self.open = False
+            return
+        event = self.events[-1]
+        number = i + 1
+        seconds = round(number/self.fps, 3) if self.fps else None
+        if event['start'] is None:
+            event['start'] = number
+            event['start_seconds'] = seconds
+        event['end'] = number
+        event['end_seconds'] = seconds
+        event['peak_diff'] = max(event['peak_diff'], int(diff1))
+        event['images'].append(self._path(imname))
+
+
+def save_events(f_out, f_in, events, info, table='json'):
+    '''Writes the strike table of a video. info is video_info().'''
+    nframes, width, height, fps = info
+    if table == 'parquet':
+        video = os.path.abspath(f_in)
+        columns = {name: [event.get(name) for event in events]
+                   for name in _COLUMNS if name != 'video'}
+        columns['video'] = [video]*len(events)
+        data = pyarrow.table([columns[name] for name in _COLUMNS],
+                             names=list(_COLUMNS))
+        pyarrow.parquet.write_table(data, events_path(f_out, table))
+        return
+    with open(events_path(f_out), 'w') as f:
+        json.dump({'version': EVENTS_VERSION, 'video': os.path.abspath(f_in),
+                   'frames': nframes, 'fps': fps,
+                   'diffs': os.path.basename(f_out) + '.npy',
+                   'events': events}, f, indent=1)
+
+
+def load_strikes(out_folder):
+    """Returns every strike event in an output folder, table by table.
+
+    Each event is a dict as saved, with 'video' the analyzed file. Parquet
+    tables are only read when pyarrow is installed.
+    """
+    events = []
+    for path in sorted(glob.glob(os.path.join(out_folder, '*.strikes.json'))):
+        with open(path) as f:
+            table = json.load(f)
+        events.extend(dict(event, video=table['video'])
+                      for event in table['events'])
+    if pyarrow is not None:
+        for path in sorted(glob.glob(os.path.join(out_folder,
+                                                  '*.strikes.parquet'))):
+            events.extend(pyarrow.parquet.read_table(path).to_pylist())
+    return events
@@ -0,0 +1,137 @@
+"""Per video diff index, so a video only has to be decoded once.
+
+Every analysis saves the diff series of a video in the output folder as
+<name>.npy, with a small <name>.json describing where it came from: the
+input path, size and modification time, the video statistics and the scan
+settings. load_index hands the series back, memory mapped, only if all of
+that still matches, so changing the threshold can skip decoding entirely.
+"""
+
+import json
+import math
+import os
+
+import numpy as np
+
+from zapcapture.diff import SCALE
+from zapcapture.mask import input_mask, mask_key
+
+# 2: downscaled scans record refined_for too; older ones may not have.
+INDEX_VERSION = 2
+# Options for a fast scan: frames shrunk to about 320x180 and about 30
+# diffs a second until something happens.
+FAST_SIZE = (320, 180)
+FAST_RATE = 30
+
+
+def index_paths(f_out):
+    '''Returns the (series, description) paths for an output base name.'''
+    return f_out + '.npy', f_out + '.json'
+
+
+def source_key(f_in):
+    '''Identifies an input file by absolute path, size and mtime.'''
+    stat = os.stat(f_in)
+    return {'path': os.path.abspath(f_in), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def background_key(options):
+    '''The running average weight, None for the previous frame diff.'''
+    if options.background == 'average':
+        return float(options.background_alpha)
+    return None
+
+
+def scan_plan(width, height, fps, options):
+    """The (scale, stride) a two pass scan of a video runs at.
+
+    options.scan_pixels picks the scale from the frame size, the largest
+    1/n up to SCALE that shrinks frames to at most that many pixels, and
+    options.scan_rate the stride from the fps. Without them scan_scale and
+    scan_stride are used as they are. A running average background needs
+    every frame, so it is never strided.
+    """
+    scale = float(options.scan_scale)
+    if options.scan_pixels:
+        pixels = max(1, width*height)/options.scan_pixels
+        scale = 1/max(round(1/SCALE), math.ceil(math.sqrt(pixels)))
+    stride = max(1, int(options.scan_stride))
+    if options.scan_rate:
+        stride = max(1, int(fps/options.scan_rate))
+    if background_key(options) is not None:
+        stride = 1
+    return scale, stride
+
+
+def scan_settings(threshold, options, two_pass=True, mask=None, plan=None):
+    """Describes how a diff series was made.
+
+    A strided or downscaled scan only looked closely where the diff came
+    near the threshold it was run with, so that threshold is kept as
+    refined_for. With a running average background nothing is refined.
+    mask is the input_mask the diffs were counted in and plan the
+    scan_plan of a two pass scan.
+    """
+    scan = {'scale': SCALE, 'gray': bool(options.gray_diff), 'stride': 1,
+            'refined_for': None, 'mask': mask_key(mask),
+            'background': background_key(options),
+            'decoder': options.decoder}
+    if two_pass:
+        scale, stride = plan
+        # the same test as scan_diffs for switching to the coarse scan
+        switching = ((stride > 1 or scale != SCALE)
+                     and scan['background'] is None)
+        scan.update(scale=scale, stride=stride,
+                    refined_for=int(threshold) if switching else None)
+    return scan
+
+
+def save_index(f_out, f_in, diffs, info, scan):
+    '''Saves a diff series with its description. info is video_info().'''
+    series, description = index_paths(f_out)
+    np.save(series, np.asarray(diffs, np.int64))
+    nframes, width, height, fps = info
+    meta = {'version': INDEX_VERSION, 'source': source_key(f_in),
+            'frames': nframes, 'width': width, 'height': height, 'fps': fps,
+            'scan': scan}
+    with open(description, 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def load_index(f_out, f_in, threshold, options):
+    """Returns (diffs, meta) for f_in if a usable index exists, else None.
+
+    diffs is memory mapped. The index is usable when the input is unchanged
+    and it was scanned at the same scale, color mode, mask, background
+    model and decoder. A strided or downscaled index is only usable for
+    thresholds at or above the one it was refined for; at lower thresholds
+    it may have skipped frames, or kept coarse counts, that now matter.
+    """
+    series, description = index_paths(f_out)
+    try:
+        with open(description) as f:
+            meta = json.load(f)
+        if meta.get('version') != INDEX_VERSION:
+            return None
+        if meta['source'] != source_key(f_in):
+            return None
+        scan = meta['scan']
+        if scan['gray'] != bool(options.gray_diff):
+            return None
+        plan = scan_plan(meta['width'], meta['height'], meta['fps'], options)
+        if scan['scale'] not in (SCALE, plan[0]):
+            return None
+        if scan['refined_for'] is not None and int(threshold) < scan['refined_for']:
+            return None
+        if scan.get('background') != background_key(options):
+            return None
+        if scan.get('decoder', 'opencv') != options.decoder:
+            return None
+        mask = input_mask(f_in, meta['width'], meta['height'], options)
+        if scan.get('mask') != mask_key(mask):
+            return None
+        diffs = np.load(series, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    return diffs, meta
@@ -0,0 +1,201 @@
+"""Run manifest and checkpoints, so a stopped batch can pick up again.
+
+The manifest in the output folder records every input that has been looked
+at: its size, modification time and a quick content hash, the settings it
+was analyzed with and whether it finished. With Options.resume a rerun
+skips the inputs that finished with the same settings, so adding new
+footage to an archive only costs the new footage.
+
+A long video analyzed sequentially also saves a checkpoint now and then,
+<video>.checkpoint.json next to its outputs, at a frame where no strike is
+in progress, with the diffs so far in <video>.diffs.part. A resumed run
+carries on from there instead of the first frame.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from zapcapture.index import source_key
+from zapcapture.options import Options
+
+MANIFEST_NAME = 'zapcapture_manifest.json'
+MANIFEST_VERSION = 1
+# bytes hashed from each end of a file. Hashing whole videos would cost
+# as much as decoding them.
+HASH_BYTES = 2**20
+# settings that change how fast a run is, but not what it writes
+SPEED_OPTIONS = ('prefetch', 'write_threads', 'write_queue', 'profile',
+                 'reanalyze', 'resume', 'watch_settle', 'watch_interval',
+                 'watch_queue', 'decode_threads')
+
+
+def quick_hash(f_in):
+    '''sha1 of the size and the first and last HASH_BYTES of a file.'''
+    size = os.path.getsize(f_in)
+    digest = hashlib.sha1(str(size).encode())
+    with open(f_in, 'rb') as f:
+        digest.update(f.read(HASH_BYTES))
+        if size > HASH_BYTES:
+            f.seek(max(HASH_BYTES, size - HASH_BYTES))
+            digest.update(f.read(HASH_BYTES))
+    return digest.hexdigest()
+
+
+def run_params(threshold, name_by_frame, options):
+    '''The settings that decide what an analysis writes.'''
+    params = {name: value for name, value in options.as_dict().items()
+              if name not in SPEED_OPTIONS}
+    params['threshold'] = int(threshold)
+    params['name_by_frame'] = bool(name_by_frame)
+    return params
+
+
+def same_params(saved, params):
+    '''Compares run_params, counting settings added since as defaults.'''
+    for name in set(saved) | set(params):
+        default = getattr(Options, name, None)
+        if saved.get(name, default) != params.get(name, default):
+            return False
+    return True
+
+
+def _write_json(path, data):
+    # written aside and renamed, so a crash never leaves half a file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class Manifest:
+    """The manifest of an output folder, for one set of run settings.
+
+    Inputs are keyed by file name, like their outputs. Call save() to write
+    changes; analyze_folder saves after every video.
+    """
+
+    def __init__(self, out_folder, params):
+        self.path = os.path.join(out_folder, MANIFEST_NAME)
+        self.params = params
+        data = _read_json(self.path)
+        if data is None or data.get('version') != MANIFEST_VERSION:
+            data = {'version': MANIFEST_VERSION, 'files': {}}
+        self.files = data['files']
+
+    def finished(self, f_in):
+        """True if f_in was analyzed to the end with these settings.
+
+        A file with a new modification time but the same size and quick
+        hash, eg. one copied into the archive again, still counts.
+        """
+        entry = self.files.get(os.path.basename(f_in))
+        if entry is None or entry['status'] == 'pending':
+            return False
+        if not same_params(entry['params'], self.params):
+            return False
+        source = source_key(f_in)
+        if source == entry['source']:
+            return True
+        if source['size'] != entry['source']['size']:
+            return False
+        if quick_hash(f_in) != entry['hash']:
+            return False
+        entry['source'] = source
+        return True
+
+    def result(self, f_in):
+        '''The saved result of a finished input, None if it isn't a video.'''
+        entry = self.files[os.path.basename(f_in)]
+        if entry['result'] is None:
+            return None
+        return dict(entry['result'], skipped=True)
+
+    def start(self, f_in):
+        self.files[os.path.basename(f_in)] = {
+            'source': source_key(f_in), 'hash': None, 'params': self.params,
+            'status': 'pending', 'result': None}
+
+    def done(self, f_in, result):
+        '''Records f_in as finished. result is its analyze_video result.'''
+        entry = self.files[os.path.basename(f_in)]
+        entry['hash'] = quick_hash(f_in)
+        if result is None:
+            entry['status'] = 'not_video'
+            return
+        entry['status'] = 'done'
+        # the stage times belong to the run report, not the manifest
+        entry['result'] = {name: value for name, value in result.items()
+                           if name not in ('stats', 'writes')}
+
+    def save(self):
+        _write_json(self.path, {'version': MANIFEST_VERSION,
+                                'files': self.files})
+
+
+def checkpoint_path(f_out):
+    return f_out + '.checkpoint.json'
+
+
+def background_path(f_out):
+    return f_out + '.checkpoint.npy'
+
+
+def save_checkpoint(f_out, f_in, params, state, background=None):
+    """Saves the loop state of a video at a frame with no strike going.
+
+    background is the running average background of the DiffEngine, if it
+    has one; it is saved alongside as .npy.
+    """
+    if background is not None:
+        with open(background_path(f_out) + '.tmp', 'wb') as f:
+            np.save(f, background)
+        os.replace(background_path(f_out) + '.tmp', background_path(f_out))
+    _write_json(checkpoint_path(f_out), {'source': source_key(f_in),
+                                         'params': params, 'state': state,
+                                         'background': background is not None})
+
+
+def load_checkpoint(f_out, f_in, params):
+    """Returns the saved loop state if it is for this input and settings.
+
+    A saved background comes back as state['background'].
+    """
+    data = _read_json(checkpoint_path(f_out))
+    if data is None:
+        return None
+    if data.get('source') != source_key(f_in):
+        return None
+    if not same_params(data.get('params', {}), params):
+        return None
+    state = data['state']
+    # checkpoints from before the binary series kept the diffs in the csv
+    if 'diffs' not in state or not os.path.exists(series_path(f_out)):
+        return None
+    if data.get('background'):
+        try:
+            state['background'] = np.load(background_path(f_out))
+        except (OSError, ValueError):
+            return None
+    return state
+
+
+def series_path(f_out):
+    '''The binary diffs of a sequential analysis still going, for resuming.'''
+    return f_out + '.diffs.part'
+
+
+def clear_checkpoint(f_out):
+    for path in (checkpoint_path(f_out), background_path(f_out),
+                 series_path(f_out)):
+        if os.path.exists(path):
+            os.remove(path)
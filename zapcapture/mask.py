@@ -0,0 +1,73 @@
+"""Region of interest masks.
+
+A mask says which part of the frame is analyzed, so headlights, trees and
+burnt in timestamps can be left out. It can come from a png, white where
+the frame is analyzed and black where it isn't, and from polygons to
+exclude. A png next to a video named like it with .mask.png, eg.
+storm.mask.png for storm.mp4, is used for that video in place of
+Options.mask. Masks are scaled to the video, so one drawn on a screenshot
+of any size works.
+"""
+
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+# a video's own mask is its name with this in place of the extension
+MASK_SUFFIX = '.mask.png'
+
+
+def mask_path(f_in, options):
+    '''The png mask for f_in: its own .mask.png, else options.mask.'''
+    own = os.path.splitext(f_in)[0] + MASK_SUFFIX
+    if os.path.isfile(own):
+        return own
+    return options.mask
+
+
+def read_mask(path):
+    '''Reads a png mask as grayscale, raises ValueError if it can't.'''
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError('Could not read mask ' + path)
+    return image
+
+
+def input_mask(f_in, width, height, options):
+    """Returns the mask for f_in at full frame size, or None for no mask.
+
+    The mask is a uint8 array, 255 where the frame is analyzed. Polygons in
+    options.exclude are lists of [x, y] frame pixel points.
+    """
+    path = mask_path(f_in, options)
+    if path is None and not options.exclude:
+        return None
+    mask = np.full((height, width), 255, np.uint8)
+    if path is not None:
+        image = cv2.resize(read_mask(path), (width, height),
+                           interpolation=cv2.INTER_NEAREST)
+        mask[image <= 127] = 0
+    for polygon in options.exclude or ():
+        points = np.array(polygon, np.int32).reshape(-1, 1, 2)
+        cv2.fillPoly(mask, [points], 0)
+    if mask.all():
+        return None
+    return mask
+
+
+def mask_key(mask):
+    '''Short hash identifying a mask, None for no mask.'''
+    if mask is None:
+        return None
+    return hashlib.sha1(mask.tobytes()).hexdigest()[:16]
+
+
+def parse_polygon(text):
+    '''Parses "x1,y1 x2,y2 x3,y3" into [[x1, y1], [x2, y2], [x3, y3]].'''
+    points = [[int(value) for value in point.split(',')]
+              for point in text.split()]
+    if len(points) < 3 or any(len(point) != 2 for point in points):
+        raise ValueError('A polygon needs at least three x,y points: ' + text)
+    return points
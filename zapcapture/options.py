@@ -0,0 +1,130 @@
+"""Analysis settings that go beyond the threshold and file naming."""
+
+
+class Options:
+    """Settings for an analysis run.
+
+    The defaults reproduce the original GUI analysis except for two: csv is
+    False, so no per frame diff text is written unless asked for, and
+    pre_trigger is 5, so clips start 5 frames before each strike. Options()
+    is always safe to pass. Set the ones you need as keyword arguments, eg.
+    Options(gray_diff=True) or Options(csv=True, pre_trigger=0) for the
+    original output. Unknown names raise TypeError.
+    """
+
+    # the threshold as a fraction of the pixels analyzed, eg. 0.01 for 1%,
+    # in place of a pixel count, so it means the same at any resolution.
+    threshold_fraction = None
+    # make each frame's threshold the median of the last threshold_window
+    # diffs plus threshold_k times their MAD, never below the fixed
+    # threshold. Noisy videos get a higher threshold, quiet ones a lower.
+    threshold_k = None
+    threshold_window = 300
+    # diff the downscaled frames in grayscale. Faster, slightly different
+    # counts to the original color diff.
+    gray_diff = False
+    # scan the whole video for the diff series first, then seek to the
+    # strikes to write images and clips. Also saves the series as .npy.
+    two_pass = False
+    # downscale used for the two pass diff scan. Smaller is faster; counts
+    # are scaled to match the default 0.5 so the threshold keeps its meaning.
+    scan_scale = 0.5
+    # two pass scans only diff every k-th frame until something happens.
+    scan_stride = 1
+    # pick the scan downscale per video so frames shrink to about this many
+    # pixels, eg. 320*180, and the stride so about scan_rate diffs are taken
+    # a second. They replace scan_scale and scan_stride when set.
+    scan_pixels = None
+    scan_rate = None
+    # reuse the saved diff index of each video if it is still valid and only
+    # read the strike frames back from the video.
+    reanalyze = False
+    # each video's strikes are saved as a table of events, 'json' or
+    # 'parquet' (needs the pyarrow package), see zapcapture.events. csv also
+    # writes the per frame diffs as text, like the original GUI did.
+    strike_table = 'json'
+    csv = False
+    # frames from just before a strike that lead each clip in, and the most
+    # memory in bytes they may take. Clips themselves are streamed to disk.
+    pre_trigger = 5
+    clip_memory = 256*2**20
+    # 'encode' writes clips from the decoded frames, 'copy' cuts them out of
+    # the video with ffmpeg without re-encoding, from the keyframe before
+    # the strike, and 'exact' copies too but re-encodes clips that don't
+    # start on a keyframe. See zapcapture.clips.
+    clip_mode = 'encode'
+    # encoding clips: 'opencv' writes mp4 only, 'ffmpeg' (needs ffmpeg on
+    # the PATH) also gif and webp. clip_codec is an ffmpeg encoder to use
+    # instead of the format's own, eg. 'h264_nvenc' to encode on the
+    # graphics card, and clip_quality its crf (mp4) or quality 0-100
+    # (webp). clip_fps 0 plays clips at the video's own frame rate.
+    clip_encoder = 'opencv'
+    clip_format = 'mp4'
+    clip_codec = None
+    clip_quality = None
+    clip_fps = 4.0
+    # 'opencv', 'ffmpeg' (needs ffmpeg on the PATH) or 'pyav' (needs the av
+    # package), see zapcapture.decode. decode_threads is the decoder's own
+    # thread count, 0 for its default, and hw_decode asks it to use the
+    # graphics card where it can.
+    decoder = 'opencv'
+    decode_threads = 0
+    hw_decode = False
+    # frames decoded ahead on a background thread, into reused buffers.
+    # 0 decodes in the analysis thread.
+    prefetch = 4
+    # strike images and clips are written by background threads. 0 writes
+    # them inline. write_queue is how many writes may wait before the
+    # analysis has to wait for the disk.
+    write_threads = 2
+    write_queue = 8
+    # 'png', 'jpg' or 'webp'. image_quality is the png compression (0-9) or
+    # the jpg/webp quality (0-100); None keeps the opencv default.
+    image_format = 'png'
+    image_quality = None
+    # run each video under cProfile and save the profile in the output
+    # folder as <video>.prof. Chunks scanned on other processes aren't
+    # included.
+    profile = False
+    # skip videos the manifest in the output folder lists as finished with
+    # the same settings, and carry on stopped videos from their checkpoint.
+    resume = False
+    # png mask of the area to analyze, white analyzed and black ignored, and
+    # polygons to leave out, as lists of [x, y] frame pixel points. A video
+    # with its own <name>.mask.png uses that instead of mask.
+    mask = None
+    exclude = None
+    # 'previous' diffs each frame with the one before it, 'average' with a
+    # running average background that moves background_alpha of the way to
+    # each new frame.
+    background = 'previous'
+    background_alpha = 0.05
+    # watch mode (see zapcapture.watch). A file counts as written once its
+    # size has not changed for watch_settle seconds, checking every
+    # watch_interval seconds. watch_queue segments may wait per analysis
+    # thread; after that the watch stops picking up files until it catches
+    # up. A camera with no new segment for watch_idle seconds has its clip
+    # finished. camera_pattern matches a file name without its extension;
+    # its first group names the camera, so cam1_0001 and cam1_0002 are
+    # consecutive segments of cam1.
+    watch_settle = 2.0
+    watch_interval = 1.0
+    watch_queue = 4
+    watch_idle = 600.0
+    camera_pattern = r'(.*?)[-_]?\d+'
+
+    def __init__(self, **settings):
+        for name, value in settings.items():
+            if name.startswith('_') or not hasattr(type(self), name):
+                raise TypeError('Unknown option: ' + name)
+            setattr(self, name, value)
+
+    def as_dict(self):
+        '''Returns every setting, defaults included, by name.'''
+        return {name: getattr(self, name) for name in dir(type(self))
+                if not name.startswith('_')
+                and not callable(getattr(type(self), name))}
+
+    def __repr__(self):
+        settings = ', '.join('%s=%r' % item for item in sorted(vars(self).items()))
+        return 'Options(%s)' % settings
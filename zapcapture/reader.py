@@ -0,0 +1,167 @@
+"""Decoding ahead of the analysis.
+
+FrameReader decodes on a background thread while the caller diffs the
+previous frame, so decode and analysis overlap. Frames are decoded into a
+small pool of reused buffers with VideoCapture.read(image=buffer); the
+caller hands each one back with release() when done with it, and must copy
+anything it wants to keep.
+"""
+
+import queue
+import threading
+
+import cv2
+
+# frame buffers decoded ahead of the analysis
+PREFETCH = 4
+# frames to grab through before a seek is cheaper
+SEEK_GAP = 30
+
+
+def strided(first, stop, stride):
+    '''Frame numbers first, first+stride, ... always ending with stop.'''
+    number = first
+    while number < stop:
+        yield number
+        number = number + stride
+    yield stop
+
+
+def every_frame(first):
+    '''Frame numbers first, first+1, ... without end.'''
+    number = first
+    while True:
+        yield number
+        number = number + 1
+
+
+class _Stopped(Exception):
+    pass
+
+
+# put in the buffer pool to stop the decoding thread
+_STOP = object()
+
+
+class FrameReader:
+    """Reads frames of an open cv2.VideoCapture, decoding ahead.
+
+    numbers is an increasing iterable of the frame numbers wanted, or None
+    for every frame. Frames in between are skipped with grab(), which skips
+    the color conversion, or with a seek when the gap is over seek_gap.
+    position is the frame number the capture will produce next.
+
+    read() returns (number, frame), or (None, None) at the end. buffers is
+    how many frames may be decoded ahead and held is how many the caller
+    keeps before releasing them. With buffers=0 frames are decoded in the
+    calling thread instead; otherwise close() has to be called to stop the
+    decoding thread.
+    """
+
+    def __init__(self, video, numbers=None, buffers=PREFETCH, position=0,
+                 seek_gap=SEEK_GAP, held=1):
+        self.video = video
+        self.threaded = buffers > 0
+        self.position = position
+        self.seek_gap = seek_gap
+        # None entries are buffers that get allocated by their first read
+        self.free = queue.Queue()
+        for k in range(buffers + held):
+            self.free.put(None)
+        self.thread = None
+        self._start(numbers)
+
+    def _start(self, numbers):
+        self.frames = self._decode(numbers)
+        if not self.threaded:
+            return
+        self.ready = queue.Queue()
+        self.thread = threading.Thread(target=self._work, args=(self.frames,))
+        self.thread.start()
+
+    def _take(self):
+        if not self.threaded:
+            try:
+                return self.free.get_nowait()
+            except queue.Empty:
+                return None
+        buffer = self.free.get()
+        if buffer is _STOP:
+            raise _Stopped()
+        return buffer
+
+    def _decode(self, numbers):
+        # yields (number, frame) for the wanted frames
+        if numbers is None:
+            numbers = every_frame(self.position)
+        for number in numbers:
+            if number < self.position or number - self.position > self.seek_gap:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, number)
+                self.position = number
+            while self.position < number:
+                if not self.video.grab():
+                    return
+                self.position = self.position + 1
+            buffer = self._take()
+            if buffer is None:
+                flag, frame = self.video.read()
+            else:
+                flag, frame = self.video.read(image=buffer)
+            if not flag:
+                self.release(buffer)
+                return
+            self.position = self.position + 1
+            yield number, frame
+
+    def _work(self, frames):
+        try:
+            for item in frames:
+                self.ready.put(item)
+        except _Stopped:
+            return
+        except Exception as e:
+            self.ready.put(e)
+            return
+        self.ready.put((None, None))
+
+    def read(self):
+        '''Returns the next (number, frame), or (None, None) at the end.'''
+        if not self.threaded:
+            return next(self.frames, (None, None))
+        item = self.ready.get()
+        if isinstance(item, Exception):
+            raise item
+        if item[0] is None:
+            # keep answering the end
+            self.ready.put(item)
+        return item
+
+    def release(self, frame):
+        '''Hands a frame buffer back for reuse.'''
+        if frame is not None:
+            self.free.put(frame)
+
+    def restart(self, numbers):
+        '''Drops anything decoded ahead and carries on with numbers.'''
+        self.close()
+        self._start(numbers)
+
+    def close(self):
+        '''Stops the decoding thread. Does not release the capture.'''
+        if self.thread is None:
+            return
+        self.free.put(_STOP)
+        self.thread.join()
+        self.thread = None
+        # frames decoded ahead go back into the pool, stop markers out of it
+        buffers = []
+        while not self.ready.empty():
+            item = self.ready.get()
+            if isinstance(item, tuple) and item[1] is not None:
+                buffers.append(item[1])
+        while not self.free.empty():
+            buffer = self.free.get()
+            if buffer is not _STOP:
+                buffers.append(buffer)
+        for buffer in buffers:
+            self.free.put(buffer)
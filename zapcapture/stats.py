@@ -0,0 +1,117 @@
+"""Per stage timers and counters for an analysis run.
+
+Every video analysis fills a StageTimer with the wall clock seconds spent
+opening, decoding, diffing, writing the diffs and so on, plus counters such as
+frames and bytes written. The result dicts carry it as 'stats', and
+analyze_folder saves them all to a json run report in the output folder.
+"""
+
+import cProfile
+import json
+import os
+import time
+
+# run report written into the output folder
+REPORT_NAME = 'zapcapture_report.json'
+
+
+class StageTimer:
+    """Seconds and counters per stage of one video analysis.
+
+    add() adds seconds measured by the caller, which keeps the per frame
+    stages down to two perf_counter calls. Seconds of stages that run on
+    background threads (image writes, clip encoding) overlap the others, so
+    the stages can add up to more than the total.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        self.start = time.perf_counter()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def since(self, stage, start):
+        '''Adds the time from start to now to stage, returns now.'''
+        now = time.perf_counter()
+        self.add(stage, now - start)
+        return now
+
+    def writes(self, stats):
+        '''Adds the stages and counters of OutputWriter stats.'''
+        self.add('image_write', stats['image_seconds'])
+        self.add('clip_encode', stats['clip_seconds'])
+        self.count('images', stats['images'])
+        self.count('clip_frames', stats['clip_frames'])
+        self.count('bytes_written', stats['bytes'])
+
+    def written(self, *paths):
+        '''Counts the size of files written in the analysis thread.'''
+        for path in paths:
+            if os.path.exists(path):
+                self.count('bytes_written', os.path.getsize(path))
+
+    def as_dict(self):
+        return {'total_seconds': round(time.perf_counter() - self.start, 4),
+                'seconds': {stage: round(seconds, 4)
+                            for stage, seconds in self.seconds.items()},
+                'counts': dict(self.counts)}
+
+
+def totals(results):
+    '''Sums the stage seconds and counters of a list of result dicts.'''
+    seconds = {}
+    counts = {}
+    for result in results:
+        stats = result.get('stats', {})
+        for stage, value in stats.get('seconds', {}).items():
+            seconds[stage] = round(seconds.get(stage, 0.0) + value, 4)
+        for name, value in stats.get('counts', {}).items():
+            counts[name] = counts.get(name, 0) + value
+    return {'seconds': seconds, 'counts': counts}
+
+
+def save_report(path, report):
+    '''Writes a run report as json.'''
+    with open(path, 'w') as fff:
+        json.dump(report, fff, indent=1, default=str)
+
+
+def load_report(path):
+    with open(path) as fff:
+        return json.load(fff)
+
+
+def summary(report):
+    '''A few lines about a run report, for people rather than scripts.'''
+    counts = report['totals']['counts']
+    lines = ['Videos: %d' % len(report['videos']),
+             'Frames: %d' % counts.get('frames', 0),
+             'Strikes: %d' % counts.get('strikes', 0),
+             'Images: %d' % counts.get('images', 0),
+             'Written: %.1f MB' % (counts.get('bytes_written', 0)/2**20),
+             'Process Time: %.1f s' % report['seconds']]
+    skipped = sum(1 for video in report['videos'] if video.get('skipped'))
+    if skipped:
+        lines.insert(1, 'Already Done: %d' % skipped)
+    stages = sorted(report['totals']['seconds'].items(),
+                    key=lambda item: -item[1])
+    for stage, seconds in stages:
+        lines.append('  %s: %.1f s' % (stage, seconds))
+    return '\n'.join(lines)
+
+
+def profile_call(path, function, *args, **kwargs):
+    '''Runs function under cProfile and saves the profile to path.
+
+    Open it with python -m pstats path, or snakeviz.
+    '''
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
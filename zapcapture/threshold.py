@@ -0,0 +1,110 @@
+"""Thresholds that carry over between videos of different sizes.
+
+The plain threshold is a count of changed pixels, so the same value means
+something very different on 720p and 4K footage. Options.threshold_fraction
+gives it as a fraction of the pixels analyzed instead, and
+Options.threshold_k makes it follow the video: each frame's threshold is
+the median of the recent diffs plus k times their median absolute
+deviation (MAD), never below the fixed threshold. Noisy footage gets a
+higher threshold and quiet footage a lower one, so one setting can work
+across a whole folder.
+"""
+
+import bisect
+import collections
+
+import numpy as np
+
+from zapcapture.diff import SCALE
+
+# diffs the rolling median and MAD are taken over
+WINDOW = 300
+# no strikes until this many diffs have been seen
+MIN_SAMPLES = 10
+# scales the MAD to a standard deviation for normally distributed noise
+MAD_SCALE = 1.4826
+# settings of the GUI's automatic threshold
+AUTO_K = 6.0
+AUTO_FRACTION = 0.002
+
+
+def base_threshold(threshold, width, height, mask, options):
+    """The fixed threshold for a video, in changed pixels at SCALE.
+
+    With options.threshold_fraction that fraction of the pixels analyzed,
+    inside mask if there is one, else threshold itself.
+    """
+    if options.threshold_fraction is None:
+        return int(threshold)
+    pixels = round(width*SCALE)*round(height*SCALE)
+    if mask is not None:
+        pixels = pixels*np.count_nonzero(mask)/mask.size
+    return int(options.threshold_fraction*pixels)
+
+
+class RollingThreshold:
+    """median + k*MAD of the last window diffs, at least base.
+
+    push() each diff after asking for the level() it is compared with, so
+    a frame never raises its own threshold. The window is kept sorted, so
+    the median is a lookup and the MAD a binary search over it.
+    """
+
+    def __init__(self, base, k, window=WINDOW):
+        self.base = base
+        self.k = k
+        self.window = window
+        self.recent = collections.deque()
+        self.ordered = []
+
+    def push(self, diff1):
+        diff1 = int(diff1)
+        self.recent.append(diff1)
+        bisect.insort(self.ordered, diff1)
+        if len(self.recent) > self.window:
+            old = self.recent.popleft()
+            del self.ordered[bisect.bisect_left(self.ordered, old)]
+
+    def level(self):
+        '''The threshold for the next diff.'''
+        ordered = self.ordered
+        if len(ordered) < MIN_SAMPLES:
+            return float('inf')
+        median = ordered[(len(ordered) - 1)//2]
+        # smallest d with half the window within median +- d
+        need = (len(ordered) + 1)//2
+        low = 0
+        high = max(median - ordered[0], ordered[-1] - median)
+        while low < high:
+            d = (low + high)//2
+            inside = (bisect.bisect_right(ordered, median + d)
+                      - bisect.bisect_left(ordered, median - d))
+            if inside >= need:
+                high = d
+            else:
+                low = d + 1
+        return max(self.base, median + self.k*MAD_SCALE*max(low, 1))
+
+
+def rolling_threshold(base, options):
+    '''A RollingThreshold for options, None without threshold_k.'''
+    if options.threshold_k is None:
+        return None
+    return RollingThreshold(base, float(options.threshold_k),
+                            int(options.threshold_window))
+
+
+def frame_thresholds(diffs, base, options):
+    """The threshold of every diff in a series.
+
+    Returns base itself when the threshold doesn't adapt, else an array the
+    length of diffs, the same levels a sequential pass would use.
+    """
+    rolling = rolling_threshold(base, options)
+    if rolling is None:
+        return base
+    levels = np.empty(len(diffs), np.float64)
+    for i, diff1 in enumerate(np.asarray(diffs).tolist()):
+        levels[i] = rolling.level()
+        rolling.push(diff1)
+    return levels
@@ -0,0 +1,397 @@
+"""Watch folder mode, for cameras recording in rolling segments.
+
+watch_folder analyzes new videos as soon as they have been written and
+carries on until stopped. Consecutive segments from the same camera are
+analyzed as one long video: the last frame, the deadzone, the pre-trigger
+frames and an open clip all carry over, so a strike across a file boundary
+gives one clip. Within a segment the output matches analyze_video, and a
+strike on the first frame of a segment is saved under the name of the
+previous segment's last loop index, the way loop index i always saves
+frame i+1.
+
+Segments count as written when inotify reports them closed (if the
+optional inotify_simple package is installed) or when their size and
+modification time stop changing, which also works on network shares.
+Paths wait in small bounded queues, so a long storm backs up into the
+folder rather than into memory.
+"""
+
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+
+from zapcapture.clips import (
+    FrameRing,
+    clip_extension,
+    clip_rate,
+    pre_trigger_count,
+)
+from zapcapture.core import (
+    StrikeTracker,
+    check_settings,
+    diff_engine,
+    folder_inputs,
+    open_csv,
+    output_dirs,
+    output_names,
+    video_info,
+)
+from zapcapture.decode import open_video
+from zapcapture.events import EventLog, events_path, save_events
+from zapcapture.index import save_index, scan_settings
+from zapcapture.manifest import Manifest, run_params
+from zapcapture.mask import input_mask
+from zapcapture.options import Options
+from zapcapture.reader import FrameReader
+from zapcapture.stats import StageTimer
+from zapcapture.threshold import base_threshold, rolling_threshold
+from zapcapture.writer import OutputWriter, image_extension
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+def camera_name(f_in, pattern):
+    '''The camera a segment is from: its name up to the segment number.'''
+    stem = os.path.splitext(os.path.basename(f_in))[0]
+    match = re.fullmatch(pattern, stem)
+    if match is None:
+        return stem
+    return match.group(1)
+
+
+def written_files(folder, settle=2.0, interval=1.0, stop=None):
+    """Yields the files in folder as they finish being written.
+
+    Files already there count too. A file is yielded once, when inotify
+    reports it closed or moved in, or when its size and modification time
+    have not changed for settle seconds. Stops when stop is set.
+    """
+    if stop is None:
+        stop = threading.Event()
+    notify = None
+    if INotify is not None:
+        try:
+            notify = INotify()
+            notify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO)
+        except OSError:
+            # no inotify here, eg. some network shares
+            notify = None
+    # path -> ((size, mtime), time it was first seen like that)
+    seen = {}
+    done = set()
+    try:
+        while not stop.is_set():
+            ready = []
+            if notify is not None:
+                for event in notify.read(timeout=int(interval*1000)):
+                    ready.append(os.path.join(folder, event.name))
+            else:
+                stop.wait(interval)
+            now = time.monotonic()
+            for f_in in sorted(folder_inputs(folder)):
+                if f_in in done:
+                    continue
+                try:
+                    stat = os.stat(f_in)
+                except OSError:
+                    continue
+                key = (stat.st_size, stat.st_mtime_ns)
+                if f_in not in seen or seen[f_in][0] != key:
+                    seen[f_in] = (key, now)
+                elif now - seen[f_in][1] >= settle:
+                    ready.append(f_in)
+            for f_in in ready:
+                if f_in not in done and os.path.isfile(f_in):
+                    done.add(f_in)
+                    seen.pop(f_in, None)
+                    yield f_in
+    finally:
+        if notify is not None:
+            notify.close()
+
+
+class CameraStream:
+    """Analyzes the segments of one camera as one long video.
+
+    analyze() each segment in order. The detection state carries over from
+    the previous segment when the frame size matches; end() drops it,
+    closing any clip still open.
+    """
+
+    def __init__(self, out_folder, threshold, name_by_frame, options, writer):
+        self.out_folder = out_folder
+        self.threshold = threshold
+        self.name_by_frame = name_by_frame
+        self.options = options
+        self.writer = writer
+        self.size = None
+        self.last = None
+        self.mask = None
+        # when the last segment was analyzed, for closing idle cameras
+        self.touched = time.monotonic()
+        self.clip = None
+        # the segment being analyzed, and the frame rate of its clips
+        self.source = None
+        self.fps = None
+        self.end()
+
+    def end(self):
+        '''Closes the open clip and forgets the previous segment.'''
+        if self.clip is not None:
+            self.writer.close_clip(self.clip)
+        self.tracker = StrikeTracker(self.threshold)
+        self.rolling = None
+        self.engine = None
+        self.ring = None
+        self.clip = None
+        # (names, loop index) for the next diff, None before the first frame
+        self.at = None
+
+    def analyze(self, f_in):
+        """Analyzes the next segment.
+
+        Returns its result dict like analyze_video, with 'continued' set
+        when it carried on from the previous segment, or None if f_in is
+        not a video.
+        """
+        options = self.options
+        timer = StageTimer()
+        impath, gifpath = output_dirs(self.out_folder)
+        filename = os.path.basename(f_in)
+        f_out = os.path.join(self.out_folder, filename)
+        video = open_video(f_in, options)
+        nframes, width, height, fps = video_info(video)
+        if fps == 0 or nframes == 1:
+            video.release()
+            return None
+        if (self.at is None or (width, height) != self.size
+                or filename < self.last):
+            # not a continuation of the last segment
+            self.end()
+            self.size = (width, height)
+            self.ring = FrameRing(pre_trigger_count(width, height, options))
+            self.mask = input_mask(f_in, width, height, options)
+            self.base = base_threshold(self.threshold, width, height,
+                                       self.mask, options)
+            self.tracker = StrikeTracker(self.base)
+            self.rolling = rolling_threshold(self.base, options)
+            self.engine = diff_engine(options, self.mask)
+        carried = self.at is not None
+        print('Processing ' + filename + (' after ' + self.last
+                                          if carried else ''))
+        self.last = filename
+        self.touched = time.monotonic()
+        strikes = self.tracker.strikes
+        before = self.writer.stats()
+        extension = image_extension(options)
+        gif_extension = clip_extension(options, f_in)
+        name = filename.replace('.', '_')
+        self.source = f_in
+        self.fps = clip_rate(options, fps)
+
+        def names(i):
+            return output_names(impath, gifpath, name, i, fps,
+                                self.name_by_frame, extension, gif_extension)
+
+        reader = FrameReader(video, buffers=options.prefetch,
+                             held=self.ring.capacity + 1)
+        events = EventLog(fps, self.out_folder)
+        clock = timer.since('open', timer.start)
+        try:
+            diffs = self._loop(reader, names, f_out, events, timer, clock)
+        finally:
+            reader.close()
+            video.release()
+        # this segment's images are on disk before it counts as done
+        clock = time.perf_counter()
+        self.writer.flush()
+        clock = timer.since('write_wait', clock)
+        save_index(f_out, f_in, diffs, (nframes, width, height, fps),
+                   scan_settings(self.base, options, two_pass=False,
+                                 mask=self.mask))
+        save_events(f_out, f_in, events.events, (nframes, width, height, fps),
+                    options.strike_table)
+        timer.since('index', clock)
+        after = self.writer.stats()
+        timer.writes({key: after[key] - before[key] for key in (
+            'images', 'clip_frames', 'bytes', 'image_seconds', 'clip_seconds')})
+        timer.count('frames', len(diffs))
+        timer.count('strikes', self.tracker.strikes - strikes)
+        csv = f_out + '.csv' if options.csv else None
+        table = events_path(f_out, options.strike_table)
+        timer.written(table, f_out + '.npy', f_out + '.json')
+        if csv is not None:
+            timer.written(csv)
+        return {'file': f_in, 'frames': nframes,
+                'strikes': self.tracker.strikes - strikes,
+                'events': table, 'diffs': f_out + '.npy', 'csv': csv,
+                'continued': carried, 'stats': timer.as_dict()}
+
+    def _loop(self, reader, names, f_out, events, timer, clock):
+        # The analyze_video loop, except that the first frame is compared
+        # with the last one of the previous segment when there is one.
+        writer = self.writer
+        diffs = []
+        with open_csv(f_out, self.options) as fff:
+            while True:
+                number, frame1 = reader.read()
+                clock = timer.since('decode', clock)
+                if frame1 is None:
+                    break
+                diff1 = self.engine.push(frame1)
+                clock = timer.since('diff', clock)
+                if diff1 is not None:
+                    imname, gifname = self.at[0](self.at[1])
+                    level = None
+                    if self.rolling is not None:
+                        level = self.rolling.level()
+                        self.rolling.push(diff1)
+                    save, new_clip = self.tracker.update(diff1, level)
+                    if self.clip is not None and (new_clip or not save):
+                        writer.close_clip(self.clip)
+                        self.clip = None
+                    if new_clip:
+                        self.clip = writer.open_clip(gifname, self.size,
+                                                     self.fps)
+                        for frame, source in self.ring.items():
+                            writer.clip_frame(self.clip, frame.copy(), source)
+                    if save:
+                        saved = frame1.copy()
+                        writer.image(imname, saved)
+                        writer.clip_frame(self.clip, saved,
+                                          (self.source, number))
+                    if number > 0:
+                        # the boundary diff belongs to the previous segment
+                        diffs.append(diff1)
+                        events.add(self.at[1], diff1, save, new_clip, imname,
+                                   gifname)
+                        if fff is not None:
+                            fff.write(str(f_out)+', '+str(diff1)+'\n')
+                    else:
+                        # the boundary frame is frame 0 of this segment
+                        if self.clip is not None and not new_clip:
+                            events.carry(self.clip['path'])
+                        events.add(-1, diff1, save, new_clip, imname,
+                                   gifname)
+                reader.release(self.ring.push(frame1, (self.source, number)))
+                self.at = (names, number)
+                clock = timer.since('write_wait', clock)
+        return diffs
+
+
+class _Lane:
+    # One analysis thread with its own bounded queue and writer. Each camera
+    # always goes to the same lane, so its segments stay in order.
+
+    def __init__(self, out_folder, threshold, name_by_frame, options,
+                 finished):
+        self.args = (out_folder, threshold, name_by_frame, options)
+        self.options = options
+        self.finished = finished
+        self.queue = queue.Queue(options.watch_queue)
+        self.streams = {}
+        self.writer = OutputWriter(options)
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def put(self, camera, f_in):
+        # blocks while the lane is behind
+        self.queue.put((camera, f_in))
+
+    def _work(self):
+        try:
+            self._run()
+        except BaseException:
+            self.writer.cancel()
+            raise
+        self.writer.close()
+
+    def _run(self):
+        idle = self.options.watch_idle
+        while True:
+            try:
+                item = self.queue.get(timeout=idle)
+            except queue.Empty:
+                # the cameras have stopped, finish their clips
+                for stream in self.streams.values():
+                    stream.end()
+                self.writer.flush()
+                continue
+            if item is None:
+                break
+            now = time.monotonic()
+            for stream in self.streams.values():
+                if stream.at is not None and now - stream.touched > idle:
+                    stream.end()
+            camera, f_in = item
+            if camera not in self.streams:
+                self.streams[camera] = CameraStream(*self.args,
+                                                    writer=self.writer)
+            stream = self.streams[camera]
+            try:
+                result = stream.analyze(f_in)
+            except Exception as e:
+                # one bad segment must not stop the watch
+                print('Could not analyze ' + f_in + ': ' + str(e))
+                stream.end()
+                continue
+            self.finished(f_in, result)
+        for stream in self.streams.values():
+            stream.end()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def watch_folder(in_folder, out_folder, threshold, name_by_frame=True,
+                 workers=1, options=None, stop=None, finished=None):
+    """Analyzes videos in in_folder as they are written, until stop is set.
+
+    stop is a threading.Event; without one this runs until interrupted.
+    workers is the number of analysis threads; segments are grouped by
+    camera_name with options.camera_pattern and each camera stays on one
+    thread. Segments are recorded in the run manifest as they finish, and
+    ones it lists as finished are skipped, so a restarted watch carries on
+    with the new segments. finished(f_in, result) is called after each.
+    """
+    if options is None:
+        options = Options()
+    if stop is None:
+        stop = threading.Event()
+    check_settings(in_folder, out_folder, options)
+    output_dirs(out_folder)
+    manifest = Manifest(out_folder, run_params(threshold, name_by_frame,
+                                               options))
+    lock = threading.Lock()
+
+    def done(f_in, result):
+        with lock:
+            manifest.done(f_in, result)
+            manifest.save()
+        if finished is not None:
+            finished(f_in, result)
+
+    workers = max(1, workers or os.cpu_count() or 1)
+    lanes = [_Lane(out_folder, threshold, name_by_frame, options, done)
+             for k in range(workers)]
+    try:
+        for f_in in written_files(in_folder, options.watch_settle,
+                                  options.watch_interval, stop):
+            with lock:
+                if manifest.finished(f_in):
+                    continue
+                manifest.start(f_in)
+                manifest.save()
+            camera = camera_name(f_in, options.camera_pattern)
+            # crc32 rather than hash() so a camera keeps its lane between runs
+            lanes[zlib.crc32(camera.encode()) % workers].put(camera, f_in)
+    finally:
+        for lane in lanes:
+            lane.close()
@@ -0,0 +1,233 @@
+"""Background writing of strike images and clips.
+
+The analysis loop hands images and clip frames to an OutputWriter and
+carries on decoding. Images are encoded by a small pool of threads; clip
+frames go to one thread of their own so every clip gets its frames in
+order. Both queues are bounded, so the analysis only waits on the disk when
+the writers have fallen that far behind.
+"""
+
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from zapcapture.clips import CLIP_FPS, add_source, cut_clip, open_clip
+
+# image file formats and the opencv parameter their quality setting maps to
+IMAGE_FORMATS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION),
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def image_extension(options):
+    '''Returns the file extension for options.image_format, eg. '.png'.'''
+    try:
+        return IMAGE_FORMATS[options.image_format][0]
+    except KeyError:
+        raise ValueError('Unknown image format: ' + str(options.image_format))
+
+
+def write_image(path, frame, params=()):
+    '''cv2.imwrite that raises OSError instead of returning False.'''
+    if not cv2.imwrite(path, frame, list(params)):
+        raise OSError('Could not write image ' + path)
+
+
+class OutputWriter:
+    """Writes images and clips on background threads.
+
+    Frames passed in must not be changed afterwards; the writer keeps a
+    reference until they are on disk. With threads=0 everything is written
+    straight away in the calling thread. close() waits for the queues to
+    drain, re-raises the first write error and returns stats(). cancel()
+    stops the threads without writing what is still queued, for when the
+    analysis stops partway; one of the two has to be called.
+
+    Unless options.clip_mode is 'encode' the clip frames aren't written at
+    all, only their sources are noted, and each clip is cut from the source
+    video when it closes.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        extension, self.quality_flag = IMAGE_FORMATS[options.image_format]
+        self.params = []
+        if options.image_quality is not None:
+            self.params = [self.quality_flag, int(options.image_quality)]
+        self.threads = []
+        self.image_queue = None
+        self.clip_queue = None
+        self.error = None
+        self.cancelled = False
+        # encoded clips opened and not released yet
+        self.open = []
+        self.images = 0
+        self.clip_frames = 0
+        self.tasks = 0
+        self.write_time = 0.0
+        # seconds per kind of write, and bytes on disk afterwards
+        self.seconds = {'image': 0.0, 'clip': 0.0}
+        self.bytes = 0
+        self.max_latency = 0.0
+        self.latency_total = 0.0
+        self.puts = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.lock = threading.Lock()
+        if options.write_threads > 0:
+            self.image_queue = queue.Queue(options.write_queue)
+            self.clip_queue = queue.Queue(options.write_queue)
+            for k in range(options.write_threads):
+                self._start(self.image_queue)
+            self._start(self.clip_queue)
+
+    def _start(self, work):
+        thread = threading.Thread(target=self._work, args=(work,))
+        thread.start()
+        self.threads.append((thread, work))
+
+    def _work(self, work):
+        while True:
+            task = work.get()
+            if task is None:
+                return
+            self._run(*task)
+            work.task_done()
+
+    def _run(self, queued, kind, function, args):
+        # queued is when the task was handed over, for the latency stats.
+        # function returns the bytes it wrote, if it knows them.
+        start = time.perf_counter()
+        written = None
+        try:
+            if self.error is None and not self.cancelled:
+                written = function(*args)
+        except Exception as e:
+            self.error = e
+        end = time.perf_counter()
+        with self.lock:
+            self.tasks = self.tasks + 1
+            self.write_time = self.write_time + end - start
+            self.seconds[kind] = self.seconds[kind] + end - start
+            self.bytes = self.bytes + (written or 0)
+            latency = end - queued
+            self.latency_total = self.latency_total + latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def _put(self, work, kind, function, *args):
+        if self.error is not None:
+            raise self.error
+        if not self.threads:
+            self._run(time.perf_counter(), kind, function, args)
+            return
+        depth = work.qsize()
+        self.puts = self.puts + 1
+        self.depth_total = self.depth_total + depth
+        self.max_depth = max(self.max_depth, depth)
+        # blocks while the queue is full
+        work.put((time.perf_counter(), kind, function, args))
+
+    def image(self, path, frame):
+        '''Queues frame to be saved as an image at path.'''
+        self.images = self.images + 1
+        self._put(self.image_queue, 'image', _save_image, path, frame,
+                  self.params)
+
+    def open_clip(self, gif_name, size, fps=CLIP_FPS):
+        '''Queues a new clip to be opened, returns a handle to it.'''
+        clip = {'path': gif_name}
+        if self.options.clip_mode != 'encode':
+            clip['pieces'] = []
+            return clip
+
+        def open_writer():
+            clip['writer'] = open_clip(gif_name, size, fps, self.options)
+            self.open.append(clip)
+
+        self._put(self.clip_queue, 'clip', open_writer)
+        return clip
+
+    def clip_frame(self, clip, frame, source=None):
+        '''Queues frame to be appended to clip.
+
+        source is the frame's (video, frame number), which is all a copied
+        clip needs; frame can be None then.
+        '''
+        self.clip_frames = self.clip_frames + 1
+        if 'pieces' in clip:
+            add_source(clip['pieces'], source)
+            return
+        self._put(self.clip_queue, 'clip',
+                  lambda: clip['writer'].write(frame))
+
+    def close_clip(self, clip):
+        '''Queues the clip to be finished.'''
+        if 'pieces' in clip:
+            self._put(self.clip_queue, 'clip', cut_clip, clip['path'],
+                      clip['pieces'], self.options)
+            return
+        self._put(self.clip_queue, 'clip', self._release_clip, clip)
+
+    def _release_clip(self, clip):
+        self.open.remove(clip)
+        clip['writer'].release()
+        return os.path.getsize(clip['path'])
+
+    def flush(self):
+        '''Waits until everything queued so far is on disk.'''
+        for thread, work in self.threads:
+            work.join()
+        if self.error is not None:
+            raise self.error
+
+    def _stop(self):
+        # the threads finish what is queued before the None
+        for thread, work in self.threads:
+            work.put(None)
+        for thread, work in self.threads:
+            thread.join()
+        self.threads = []
+
+    def close(self):
+        '''Waits for everything to be written and returns stats().'''
+        self._stop()
+        if self.error is not None:
+            raise self.error
+        return self.stats()
+
+    def cancel(self):
+        """Stops the threads, dropping whatever is still queued.
+
+        Encoded clips still open are released with the frames they got so
+        far. Write errors are not raised.
+        """
+        self.cancelled = True
+        self._stop()
+        for clip in self.open:
+            try:
+                clip['writer'].release()
+            except Exception:
+                pass
+        self.open = []
+
+    def stats(self):
+        '''Counts, write times and bytes, queue depth and latency figures.'''
+        return {'images': self.images, 'clip_frames': self.clip_frames,
+                'bytes': self.bytes,
+                'write_seconds': round(self.write_time, 4),
+                'image_seconds': round(self.seconds['image'], 4),
+                'clip_seconds': round(self.seconds['clip'], 4),
+                'mean_queue_depth': round(self.depth_total/max(self.puts, 1), 2),
+                'max_queue_depth': self.max_depth,
+                'mean_latency': round(self.latency_total/max(self.tasks, 1), 4),
+                'max_latency': round(self.max_latency, 4)}
+
+
+def _save_image(path, frame, params):
+    write_image(path, frame, params)
+    return os.path.getsize(path)